@@ -0,0 +1,70 @@
+"""Startup search of the torch threads and DataLoader worker options of a run (--autotune)."""
+import copy
+import os
+import time
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+import dataloader
+
+
+def candidates(cores):
+    """(threads, workers) pairs, threads in {1, cores / 2, cores} and workers in {0, 2, 4}, with at most
+    one worker per core left to the threads."""
+    for threads in sorted({1, max(cores // 2, 1), cores}):
+        for workers in [0, 2, 4]:
+            if workers <= max(cores - threads, 1):
+                yield threads, workers
+
+
+def throughput(args, network, loader, steps, warmup=3):
+    """Training samples per second of a copy of network over steps batches of loader, after warmup batches
+    (worker start up included)."""
+    network = copy.deepcopy(network)
+    network.train()
+    optimizer = optim.Adam(network.parameters(), lr=args.lr)
+    samples = 0
+    start_time = None
+    for batch_idx, (image, question, answer, image_idx) in enumerate(dataloader.Prefetcher(loader, args.device, args.prefetch_depth)):
+        if batch_idx == warmup:
+            start_time = time.time()
+            samples = 0
+        elif batch_idx == warmup + steps:
+            break
+        optimizer.zero_grad()
+        with torch.autocast(args.device.type, dtype=torch.bfloat16, enabled=args.precision == 'bf16'):
+            loss = F.cross_entropy(network(image, question, image_idx), answer)
+        loss.backward()
+        optimizer.step()
+        samples += answer.size(0)
+    if start_time is None:
+        raise ValueError('--autotune needs more than {} training batches'.format(warmup))
+    return samples / (time.time() - start_time)
+
+
+def autotune(args, network, loader):
+    """Times training steps of network on loader over threads and workers, then over pinning and prefetching
+    for the fastest of those. Sets the fastest number of threads and returns it with its loader_config and
+    the timings of every candidate."""
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    results = []
+
+    def run(threads, loader_config):
+        torch.set_num_threads(threads)
+        speed = throughput(args, network, dataloader.reload(loader, loader_config), args.autotune_steps)
+        print('Autotune: threads {} / workers {} / pin memory {} / prefetch {}: {:.1f} samples/s'.format(
+            threads, *loader_config, speed))
+        results.append({'threads': threads, 'loader_config': loader_config, 'throughput': speed})
+
+    for threads, workers in candidates(cores):
+        run(threads, [workers, False, 2])
+    best = max(results, key=lambda result: result['throughput'])
+    threads, (workers, _, _) = best['threads'], best['loader_config']
+    for pin_memory in ([False, True] if args.device.type == 'cuda' else [False]):
+        for prefetch_factor in ([2, 4] if workers else [2]):
+            if [pin_memory, prefetch_factor] != [False, 2]:
+                run(threads, [workers, pin_memory, prefetch_factor])
+    best = max(results, key=lambda result: result['throughput'])
+    torch.set_num_threads(best['threads'])
+    print('Autotune: threads {} / workers {} / pin memory {} / prefetch {} chosen'.format(best['threads'], *best['loader_config']))
+    return dict(best, cores=cores, results=results)
@@ -0,0 +1,228 @@
+"""Micro benchmarks of the hot paths.
+
+python benchmark.py encoders --batch-size 64 --image-size 75
+python benchmark.py precision --models baseline rn sarn --image-sizes 64 75 128
+python benchmark.py collate --image-size 128
+python benchmark.py prefetch --load-ms 20 --step-ms 30 --batches 50
+python benchmark.py text-cache --batch-size 96
+"""
+import argparse
+import time
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+from torch.profiler import profile, ProfilerActivity
+from torch.nn.utils.rnn import pack_sequence
+import utils
+import dataloader
+import model
+from build_model import build_model
+from configuration import get_config
+
+
+def allocated(function, *inputs):
+    """Bytes allocated by one call of function, from the profiler memory events."""
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        function(*inputs)
+    return sum(max(event.self_cpu_memory_usage, 0) for event in prof.events())
+
+
+def timed(function, *inputs, repeat=10):
+    function(*inputs)
+    start_time = time.time()
+    for _ in range(repeat):
+        function(*inputs)
+    return (time.time() - start_time) / repeat
+
+
+def expand_baseline_encode(images, questions):
+    n, c, h, w = images.size()
+    o = h * w
+    hd = questions.size(1)
+    x_coordinate = torch.linspace(-h/2, h/2, h).view(1, 1, h, 1).expand(n, 1, h, w).to(images.device)
+    y_coordinate = torch.linspace(-w/2, w/2, w).view(1, 1, 1, w).expand(n, 1, h, w).to(images.device)
+    questions = questions.unsqueeze(2).unsqueeze(3).expand(n, hd, h, w)
+    return torch.cat([images, x_coordinate, y_coordinate, questions], 1).view(n, -1, o).transpose(1, 2).contiguous()
+
+
+def expand_rn_encode(images, questions):
+    n, c, h, w = images.size()
+    o = h * w
+    hd = questions.size(1)
+    x_coordinate = torch.linspace(-1, 1, h).view(1, h, 1, 1).expand(n, h, w, 1).contiguous().view(n, o, 1).to(images.device)
+    y_coordinate = torch.linspace(-1, 1, w).view(1, 1, w, 1).expand(n, h, w, 1).contiguous().view(n, o, 1).to(images.device)
+    images = images.view(n, c, o).transpose(1, 2)
+    images = torch.cat([images, x_coordinate, y_coordinate], 2)
+    images1 = images.unsqueeze(1).expand(n, o, o, c + 2).contiguous()
+    images2 = images.unsqueeze(2).expand(n, o, o, c + 2).contiguous()
+    questions = questions.unsqueeze(1).unsqueeze(2).expand(n, o, o, hd)
+    return torch.cat([images1, images2, questions], 3)
+
+
+def expand_sarn_encode(objects, code):
+    n, c, h, w = objects.size()
+    o = h * w
+    hd = code.size(1)
+    x_coordinate = torch.linspace(-h/2, h/2, h).view(1, 1, h, 1).expand(n, 1, h, w).to(objects.device)
+    y_coordinate = torch.linspace(-w/2, w/2, w).view(1, 1, 1, w).expand(n, 1, h, w).to(objects.device)
+    coordinate_encoded = torch.cat([objects, x_coordinate, y_coordinate], 1)
+    question = code.view(n, hd, 1, 1).expand(n, hd, h, w)
+    question_encoded = torch.cat([coordinate_encoded, question], 1).view(n, -1, o).transpose(1, 2).contiguous()
+    return coordinate_encoded.view(n, -1, o).transpose(1, 2).contiguous(), question_encoded
+
+
+def encoders(args):
+    """Allocations and time of the cached, broadcasting encoders in utils against expand + cat.
+    The expand + cat outputs are made contiguous, as the first nn.Linear of g_theta does."""
+    h = w = int(np.ceil(args.image_size / 2 ** args.cv_layer))
+    objects = torch.randn(args.batch_size, args.cv_filter, h, w)
+    code = torch.randn(args.batch_size, args.te_embedding * 2)
+    print('objects {} x {} x {} x {}'.format(args.batch_size, args.cv_filter, h, w))
+    for name, expand, broadcast in [('baseline_encode', expand_baseline_encode, utils.baseline_encode),
+                                    ('rn_encode', expand_rn_encode, utils.rn_encode),
+                                    ('sarn_encode', expand_sarn_encode, utils.sarn_encode)]:
+        with torch.no_grad():
+            broadcast(objects, code)
+            print('{:16s} expand + cat: {:9.2f} MB {:8.3f} ms / broadcast: {:9.2f} MB {:8.3f} ms'.format(
+                name,
+                allocated(expand, objects, code) / 2 ** 20, timed(expand, objects, code, repeat=args.repeat) * 1e3,
+                allocated(broadcast, objects, code) / 2 ** 20, timed(broadcast, objects, code, repeat=args.repeat) * 1e3))
+
+
+def precision(args):
+    """Training steps per second in fp32 and bf16 autocast for the models and image sizes of the README
+    results, on random Sort-of-CLEVR shaped batches. Model options (--rn-mode, --cv-layer, ...) are read
+    as in main.py."""
+    config = get_config()
+    config.label_size, config.q_size, config.c_size = 16, 8, 6
+    for model in args.models:
+        for image_size in args.image_sizes:
+            config.model = model
+            config.input_h = config.input_w = image_size
+            network = build_model(config)
+            optimizer = optim.Adam(network.parameters(), lr=config.lr)
+            image = torch.rand(args.batch_size, config.channel_size, image_size, image_size, device=config.device)
+            question = torch.stack([torch.randint(config.c_size, (args.batch_size,)),
+                                    torch.randint(config.q_size, (args.batch_size,))], 1).to(config.device)
+            answer = torch.randint(config.label_size, (args.batch_size,), device=config.device)
+            throughput = dict()
+            for mode, dtype in [('fp32', torch.float), ('bf16', torch.bfloat16)]:
+                def step():
+                    optimizer.zero_grad()
+                    with torch.autocast(config.device.type, dtype=torch.bfloat16, enabled=mode == 'bf16'):
+                        loss = F.cross_entropy(network(image.to(dtype), question), answer)
+                    loss.backward()
+                    optimizer.step()
+                throughput[mode] = args.batch_size / timed(step, repeat=args.repeat)
+            print('{:8s} {:4d}: fp32 {:9.1f} / bf16 {:9.1f} samples/s ({:.2f}x)'.format(
+                model, image_size, throughput['fp32'], throughput['bf16'], throughput['bf16'] / throughput['fp32']))
+
+
+def cat_collate_text(list_inputs):
+    list_inputs.sort(key=lambda x:len(x[1]), reverse = True)
+    images = torch.Tensor()
+    questions = []
+    answers = torch.Tensor().to(torch.long)
+    for i, q, a in list_inputs:
+        images = torch.cat([images, i.unsqueeze(0)], 0)
+        questions.append(q)
+        answers = torch.cat([answers, a], 0)
+    questions_packed = pack_sequence(questions)
+    return images, questions_packed, answers
+
+
+def collate(args):
+    """dataloader.collate_text against torch.cat accumulation on CLEVR shaped samples
+    (questions of 5 to 45 tokens)."""
+    for batch_size in [64, 128, 256, 512, 1024]:
+        batch = [(torch.rand(args.channel_size, args.image_size, args.image_size),
+                  torch.randint(3, 80, (int(torch.randint(5, 46, ())),)),
+                  torch.randint(28, (1,))) for _ in range(batch_size)]
+        print('batch {:5d}: torch.cat {:9.2f} ms / preallocated {:9.2f} ms'.format(
+            batch_size,
+            timed(lambda: cat_collate_text(list(batch)), repeat=args.repeat) * 1e3,
+            timed(lambda: dataloader.collate_text(list(batch)), repeat=args.repeat) * 1e3))
+
+
+class SlowLoader(object):
+    """batches random Sort-of-CLEVR shaped batches, each taking load_ms to load, as a loader without workers."""
+    def __init__(self, batches, batch_size, image_size, load_ms):
+        self.batches = batches
+        self.batch_size = batch_size
+        self.image_size = image_size
+        self.load_ms = load_ms
+
+    def __len__(self):
+        return self.batches
+
+    def __iter__(self):
+        for _ in range(self.batches):
+            time.sleep(self.load_ms / 1e3)
+            yield (torch.rand(self.batch_size, 3, self.image_size, self.image_size),
+                   torch.randint(6, (self.batch_size, 2)), torch.randint(10, (self.batch_size,)))
+
+
+def prefetch(args):
+    """Epoch time and data wait of dataloader.Prefetcher over a loader taking --load-ms per batch, with a
+    simulated training step of --step-ms, for each prefetch depth. Without prefetching the epoch takes
+    load + step per batch, with it about the larger of the two."""
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    loader = SlowLoader(args.batches, args.batch_size, args.image_size, args.load_ms)
+    for depth in [0, 1, 2, 4]:
+        batches = dataloader.Prefetcher(loader, device, depth)
+        start_time = time.time()
+        for image, question, answer, image_idx in batches:
+            time.sleep(args.step_ms / 1e3)
+        elapsed = time.time() - start_time
+        print('depth {}: {:8.1f} ms per batch / data wait {:8.1f} ms per batch / {}/{} batches stalled'.format(
+            depth, elapsed / len(loader) * 1e3, batches.wait / len(loader) * 1e3, batches.stalls, len(loader)))
+
+
+def text_cache(args):
+    """Checks that model.Text_cache returns the text encoder outputs of the questions of the batch in batch
+    order, on CLEVR shaped batches of --batch-size questions of few distinct lengths (ties reordered by the
+    sort of pack_sequence), packed unsorted as by serve.py and sorted as by the loaders, then times them."""
+    torch.manual_seed(0)
+    text_encoder = model.Text_encoder(80, 32, 64, 1)
+    text_encoder.eval()
+    questions = [torch.randint(3, 80, (int(torch.randint(5, 9, ())),)) for _ in range(args.batch_size)]
+    # repeated questions are encoded once by the cache
+    questions += questions[:args.batch_size // 4]
+    lengths = sorted(range(len(questions)), key=lambda n: -len(questions[n]))
+    for name, packed in [('unsorted', pack_sequence(questions, enforce_sorted=False)),
+                         ('sorted', pack_sequence([questions[n] for n in lengths]))]:
+        with torch.no_grad():
+            encoded = text_encoder(packed)
+            cache = model.Text_cache(text_encoder, len(questions))
+            cached = cache(packed)
+        error = (cached - encoded).abs().max().item()
+        if error > 1e-6:
+            raise AssertionError('{}: cached text codes differ from the text encoder by {}'.format(name, error))
+        cache = model.Text_cache(text_encoder, len(questions))
+        with torch.no_grad():
+            print('{:8s} {:4d} questions: max error {:.1e} / encoder {:8.3f} ms / cache {:8.3f} ms'.format(
+                name, len(questions), error,
+                timed(text_encoder, packed, repeat=args.repeat) * 1e3, timed(cache, packed, repeat=args.repeat) * 1e3))
+
+
+benchmarks = {'encoders': encoders, 'precision': precision, 'collate': collate, 'prefetch': prefetch,
+              'text-cache': text_cache}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='parser')
+    parser.add_argument('benchmark', type=str, choices=list(benchmarks.keys()))
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--image-size', type=int, default=75)
+    parser.add_argument('--channel-size', type=int, default=3)
+    parser.add_argument('--cv-filter', type=int, default=32)
+    parser.add_argument('--cv-layer', type=int, default=4)
+    parser.add_argument('--te-embedding', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--models', type=str, nargs='+', default=['baseline', 'rn', 'sarn'])
+    parser.add_argument('--image-sizes', type=int, nargs='+', default=[64, 75, 128])
+    parser.add_argument('--batches', type=int, default=50)
+    parser.add_argument('--load-ms', type=float, default=20)
+    parser.add_argument('--step-ms', type=float, default=30)
+    args, unparsed = parser.parse_known_args()
+    benchmarks[args.benchmark](args)
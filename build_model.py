@@ -5,7 +5,6 @@ import torch
 def build_model(args):
     device = args.device
     torch.manual_seed(args.seed)
-    models = dict()
     cv_layout = [(args.cv_filter, args.cv_kernel, args.cv_stride) for i in range(args.cv_layer)]
     if args.model == 'baseline':
         gt_layout = [(args.cv_filter + 2) + args.te_embedding * 2] + [args.gt_hidden for i in range(args.gt_layer)]
@@ -14,8 +13,6 @@ def build_model(args):
         conv = model.Conv(args.input_h, args.input_w, cv_layout, args.channel_size, args.cv_layernorm).to(device)
         g_theta = model.MLP(gt_layout).to(device)
         f_phi = model.MLP(fp_layout).to(device)
-        models['g_theta.pt'] = g_theta
-        models['f_phi.pt'] = f_phi
 
     elif args.model == 'rn':
         gt_layout = [(args.cv_filter + 2) * 2 + args.te_embedding * 2] + [args.gt_hidden for i in range(args.gt_layer)]
@@ -24,8 +21,6 @@ def build_model(args):
         conv = model.Conv(args.input_h, args.input_w, cv_layout, args.channel_size, args.cv_layernorm).to(device)
         g_theta = model.MLP(gt_layout).to(device)
         f_phi = model.MLP(fp_layout).to(device)
-        models['g_theta.pt'] = g_theta
-        models['f_phi.pt'] = f_phi
 
     elif args.model == 'sarn':
         gt_layout = [2 * (args.cv_filter + 2 + args.te_embedding)] + [args.gt_hidden for i in range(args.gt_layer)]
@@ -37,9 +32,6 @@ def build_model(args):
         g_theta = model.MLP(gt_layout).to(device)
         h_psi = model.MLP(hp_layout).to(device)
         f_phi = model.MLP(fp_layout).to(device)
-        models['g_theta.pt'] = g_theta
-        models['f_phi.pt'] = f_phi
-        models['h_psi.pt'] = h_psi
 
     elif args.model == 'sarn_att':
         gt_layout = [args.cv_filter + 2] + [args.gt_hidden for i in range(args.gt_layer)]
@@ -52,10 +44,6 @@ def build_model(args):
         h_psi = model.MLP(hp_layout).to(device)
         attn = model.MultiHeadAttention(n_head=args.attn_head, d_model=args.cv_filter + 2, d_k=args.attn_key, d_v=args.attn_val).to(device)
         f_phi = model.MLP(fp_layout).to(device)
-        models['g_theta.pt'] = g_theta
-        models['f_phi.pt'] = f_phi
-        models['h_psi.pt'] = h_psi
-        models['attn.pt'] = attn
 
     elif args.model == 'film':
         conv = model.Conv(args.input_h, args.input_w, cv_layout, args.channel_size, args.cv_layernorm).to(device)
@@ -66,7 +54,6 @@ def build_model(args):
         film = model.Film(args.te_embedding * 2, args.film_lstm_hidden, args.cv_filter, args.film_kernel,
                           args.film_res_layer, args.film_last_filter, input_h, input_w, args.film_mlp_hidden,
                           args.film_mlp_layer, args.label_size).to(device)
-        models['film.pt'] = film
 
     if args.dataset == 'clevr':
         text_encoder = model.Text_encoder(args.q_size, args.te_embedding, args.te_hidden,
@@ -74,6 +61,15 @@ def build_model(args):
     else:
         text_encoder = model.Text_embedding(args.c_size, args.q_size,
                                             args.te_embedding).to(device)
-    models['text_encoder.pt'] = text_encoder
-    models['conv.pt'] = conv
-    return models
+
+    if args.model == 'baseline':
+        network = model.Baseline(text_encoder, conv, g_theta, f_phi)
+    elif args.model == 'rn':
+        network = model.RN(text_encoder, conv, g_theta, f_phi, args.rn_mode, args.rn_chunk, args.rn_memory)
+    elif args.model == 'sarn':
+        network = model.SARN(text_encoder, conv, g_theta, f_phi, h_psi, args.sarn_topk, args.sarn_side, args.sarn_grad)
+    elif args.model == 'sarn_att':
+        network = model.SARN_att(text_encoder, conv, g_theta, f_phi, h_psi, attn)
+    elif args.model == 'film':
+        network = model.Film_network(text_encoder, conv, film)
+    return network
@@ -1,3 +1,4 @@
+import os
 import torch
 import argparse
 import datetime
@@ -24,9 +25,16 @@ def get_config():
     # h psi
     model_arg.add_argument('--hp-hidden', type=int, default=128)
     model_arg.add_argument('--hp-layer', type=int, default=3)
+    model_arg.add_argument('--sarn-topk', type=int, default=0, help='objects kept by h_psi logit in sarn, 0 for all')
+    model_arg.add_argument('--sarn-side', type=str, default='object', choices=['object', 'pair', 'both'], help='with --sarn-topk, attend over all objects, over the kept ones, or pair every kept row with every kept object')
+    model_arg.add_argument('--sarn-grad', type=str, default='st', choices=['st', 'soft'], help='with --sarn-topk, gradient of the kept rows to h_psi through the softmax over all objects or over the kept ones')
     # g theta
     model_arg.add_argument('--gt-hidden', type=int, default=128)
     model_arg.add_argument('--gt-layer', type=int, default=3)
+    # rn
+    model_arg.add_argument('--rn-mode', type=str, default='dense', choices=['dense', 'pairfree'])
+    model_arg.add_argument('--rn-chunk', type=int, default=0, help='pairs per chunk of the pairfree rn, 0 for all pairs at once')
+    model_arg.add_argument('--rn-memory', type=float, default=0, help='activation budget (MB) of a pairfree rn chunk, overrides --rn-chunk and checkpoints chunks')
     # f phi
     model_arg.add_argument('--fp-hidden', type=int, default=128)
     model_arg.add_argument('--fp-dropout', type=int, default=5)
@@ -55,6 +63,13 @@ def get_config():
     data_arg.add_argument('--channel-size', type=int, default=3)
     data_arg.add_argument('--input-h', type=int, default=75)
     data_arg.add_argument('--input-w', type=int, default=75)
+    data_arg.add_argument('--group-images', type=int, default=0, help='images per batch in grouped mode, 0 to sample questions independently')
+    data_arg.add_argument('--group-questions', type=int, default=48, help='questions sampled per image in grouped mode')
+    data_arg.add_argument('--stream-rate', type=float, default=0, help='scenes rendered per second by sortofclevr-stream, 0 for no limit')
+    data_arg.add_argument('--stream-val', type=str, default='fixed', choices=['fixed', 'disk'], help='sortofclevr-stream validation set: rendered once from --seed or read from disk')
+    data_arg.add_argument('--length-bucket', action='store_true', help='batch clevr questions of similar length together')
+    data_arg.add_argument('--token-budget', type=int, default=0, help='padded question tokens per length bucketed batch, 0 for --batch-size questions')
+    data_arg.add_argument('--data-resident', action='store_true', help='keep the sortofclevr split on the device and batch it there, without a DataLoader')
 
     train_arg = parser.add_argument_group('Train')
     train_arg.add_argument('--batch-size', type=int, default=64, metavar='N', help='input batch size for training (default: 64)')
@@ -68,28 +83,71 @@ def get_config():
     train_arg.add_argument('--time-stamp', type=str, default=datetime.datetime.now().strftime("%y%m%d%H%M%S"), metavar='N', help='time of the run(no modify)')
     train_arg.add_argument('--memo', type=str, default='default', metavar='N', help='memo of the model')
     train_arg.add_argument('--load-model', type=str, default='000000000000', metavar='N', help='load previous model')
+    train_arg.add_argument('--load-conv', type=str, default='', metavar='N', help='load only the conv of a previous model')
+    train_arg.add_argument('--feature-cache', action='store_true', help='freeze the conv and train the head on its cached outputs (clevr)')
+    train_arg.add_argument('--text-cache', type=int, default=0, help='distinct questions whose text encoder output is reused in evaluation, 0 to disable')
     train_arg.add_argument('--start-epoch', type=int, default=0, metavar='N', help='start-epoch number')
+    train_arg.add_argument('--threads', type=int, default=0, help='torch intra-op threads, 0 for the torch default')
+    train_arg.add_argument('--pin-memory', action='store_true', help='pin loaded batches in page-locked memory')
+    train_arg.add_argument('--prefetch-factor', type=int, default=2, help='batches loaded ahead by each of --cpu-num workers')
+    train_arg.add_argument('--prefetch-depth', type=int, default=2, help='batches loaded and copied to the device ahead of the step by a background thread, 0 to load them in the step')
+    train_arg.add_argument('--autotune', action='store_true', help='time training steps over threads and loader options at startup and keep the fastest')
+    train_arg.add_argument('--autotune-steps', type=int, default=20, help='timed training steps per autotune candidate')
+    train_arg.add_argument('--profile', action='store_true', help='log the time and peak memory per step of each component of the network, the optimizer and data loading')
+    train_arg.add_argument('--profile-trace', type=int, nargs=2, default=[0, 0], metavar=('START', 'STEPS'), help='with --profile, record a torch.profiler trace of STEPS steps from step START into the run directory')
+    train_arg.add_argument('--compile', action='store_true', help='run the composed network through torch.compile')
+    train_arg.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'], help='bf16 autocasts the network and stores dataset images in bfloat16')
 
     args, unparsed = parser.parse_known_args()
 
+    # set by torchrun, one process per rank
+    args.world_size = int(os.environ.get('WORLD_SIZE', 1))
+    args.rank = int(os.environ.get('RANK', 0))
+    args.distributed = args.world_size > 1
+    if args.distributed and args.dataset == 'sortofclevr-stream':
+        parser.error('distributed training is available for sortofclevr and clevr')
+    if args.distributed and args.autotune:
+        parser.error('--autotune times a single process, set --threads and --cpu-num per rank instead')
+
     if not torch.cuda.is_available():
         args.device = torch.device('cpu')
+    elif args.distributed:
+        args.device = int(os.environ.get('LOCAL_RANK', 0))
+        torch.cuda.set_device(args.device)
+        args.device = torch.device(args.device)
     else:
         torch.cuda.set_device(args.device)
         args.device = torch.device(args.device)
 
+    if args.feature_cache and args.dataset != 'clevr':
+        parser.error('--feature-cache is only available for clevr')
+    if args.profile and args.compile:
+        parser.error('--profile hooks the modules of the eager network, drop --compile')
+    if (args.rn_chunk or args.rn_memory) and args.rn_mode != 'pairfree':
+        parser.error('--rn-chunk and --rn-memory split the pairfree rn, add --rn-mode pairfree')
+    if args.data_resident and args.dataset != 'sortofclevr':
+        parser.error('--data-resident is only available for sortofclevr')
+    if args.data_resident and args.autotune:
+        parser.error('--autotune tunes DataLoader workers, which --data-resident does not use')
+
     if args.dataset == 'clevr':
         args.data_config = [args.input_h, args.input_w, args.cpu_num]
     else:
         args.data_config = [args.train_size, args.test_size, args.image_size, args.size, args.closest]
         args.input_h = args.image_size
         args.input_w = args.image_size
+    args.group_config = [args.group_images, args.group_questions]
+    args.stream_config = [args.seed, args.stream_rate, args.stream_val]
+    args.bucket_config = [args.length_bucket, args.token_budget, args.seed]
+    args.dist_config = [args.world_size, args.rank]
+    args.loader_config = [args.cpu_num, args.pin_memory, args.prefetch_factor]
+    args.resident_config = [args.device if args.data_resident else None, args.seed]
 
-    config_list = [args.project, args.model, args.dataset, args.epochs, args.batch_size, args.lr, args.device,
+    config_list = [args.project, args.model, args.dataset, args.epochs, args.batch_size, args.lr, args.device, args.precision,
                    'inp', args.channel_size] + args.data_config + \
                   ['cv', args.cv_filter, args.cv_kernel, args.cv_stride, args.cv_layer, args.cv_layernorm,
                    'te', args.te_embedding, args.te_hidden, args.te_layer,
-                   'hp', args.hp_hidden, args.hp_layer,
+                   'hp', args.hp_hidden, args.hp_layer, args.sarn_topk,
                    'gt', args.gt_hidden, args.gt_layer,
                    'fp', args.fp_hidden, args.fp_dropout, args.fp_dropout_rate, args.fp_layer,
                    args.memo]
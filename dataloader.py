@@ -1,211 +1,798 @@
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, IterableDataset, DataLoader, Sampler, DistributedSampler, get_worker_info
 import torch
 from torchvision import transforms
-from torch.nn.utils.rnn import pack_sequence
+from torch.nn.utils.rnn import PackedSequence, pack_padded_sequence
 import pickle
+import os
+import hashlib
+import queue
+import threading
+import time
 import numpy as np
 from PIL import Image
 import json
 import re
-from collections import defaultdict
+from array import array
+from functools import partial
+from multiprocessing import Pool
 import sort_of_clevr_generator
 from pathlib import Path
 home = str(Path.home())
 
 
+def new_batch(elem, shape):
+    """Empty tensor like elem, placed in shared memory inside DataLoader workers as default_collate does,
+    so that the batch is not copied again on its way to the main process."""
+    if get_worker_info() is not None:
+        numel = int(np.prod(shape))
+        storage = elem._typed_storage()._new_shared(numel, device=elem.device)
+        return elem.new(storage).resize_(*shape)
+    return elem.new_empty(shape)
+
+
+def images_batch(images, dtype):
+    """N x C x H x W batch of dtype in [0, 1] of uint8 N x H x W x C images, written in a single pass into
+    memory allocated as by new_batch."""
+    n, h, w, c = images.shape
+    batch = new_batch(torch.empty(0, dtype=dtype), (n, c, h, w))
+    torch.div(torch.from_numpy(images).permute(0, 3, 1, 2), 255, out=batch)
+    return batch
+
+
 def collate_text(list_inputs):
-    list_inputs.sort(key=lambda x:len(x[1]), reverse = True)
-    images = torch.Tensor()
-    questions = []
-    answers = torch.Tensor().to(torch.long)
-    for i, q, a in list_inputs:
-        images = torch.cat([images, i.unsqueeze(0)], 0)
-        questions.append(q)
-        answers = torch.cat([answers, a], 0)
-    questions_packed = pack_sequence(questions)
+    lengths = torch.tensor([len(q) for i, q, a in list_inputs])
+    lengths, order = lengths.sort(descending=True, stable=True)
+    image, question, answer = list_inputs[0]
+    images = new_batch(image, (len(list_inputs),) + tuple(image.size()))
+    questions = new_batch(question, (len(list_inputs), lengths[0].item())).zero_()
+    answers = new_batch(answer, (len(list_inputs),))
+    for n, k in enumerate(order.tolist()):
+        i, q, a = list_inputs[k]
+        images[n] = i
+        questions[n, :len(q)] = q
+        answers[n] = a
+    questions_packed = pack_padded_sequence(questions, lengths, batch_first=True)
     return images, questions_packed, answers
 
 
-def train_loader(data, data_directory = home + '/data/', batch_size = 128, data_config=[9800, 200, 75, 5, 3]):
+def collate_items(batch):
+    """Batches returned already collated by the __getitems__ of SortOfClevr and Clevr."""
+    return batch
+
+
+def collate_group(list_inputs):
+    images = torch.stack([i for i, q, a in list_inputs], 0)
+    questions = torch.cat([q for i, q, a in list_inputs], 0)
+    answers = torch.cat([a for i, q, a in list_inputs], 0)
+    image_idx = torch.cat([torch.full((len(a),), n, dtype=torch.long) for n, (i, q, a) in enumerate(list_inputs)], 0)
+    return images, questions, answers, image_idx
+
+
+class BucketBatchSampler(Sampler):
+    """Batches of questions of similar length, so that the LSTM of the text encoder runs few padded steps.
+
+    Each epoch, questions are sorted by length with ties broken at random and cut into batches of
+    batch_size, or with token_budget set, of as many questions as fit in token_budget padded tokens
+    (questions x longest length). The batches are then shuffled. The batch boundaries only depend on
+    the sorted lengths, so the number of batches is the same every epoch.
+    The order is drawn from (seed, epoch), so that with num_replicas processes each rank takes its
+    share of the same batches, as DistributedSampler does.
+    """
+    def __init__(self, lengths, batch_size, token_budget=0, shuffle=True, num_replicas=1, rank=0, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.token_budget = token_budget
+        self.shuffle = shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.bounds = self.batch_bounds(np.sort(self.lengths))
+
+    def batch_bounds(self, sorted_lengths):
+        if not self.token_budget:
+            return list(range(0, len(sorted_lengths), self.batch_size)) + [len(sorted_lengths)]
+        bounds = [0]
+        for n, length in enumerate(sorted_lengths):
+            # ascending lengths, so the longest question of the batch is the current one
+            if n > bounds[-1] and (n - bounds[-1] + 1) * length > self.token_budget:
+                bounds.append(n)
+        return bounds + [len(sorted_lengths)]
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        num_batches = len(self.bounds) - 1
+        if self.shuffle:
+            rng = np.random.default_rng((self.seed, self.epoch))
+            order = np.lexsort((rng.permutation(len(self.lengths)), self.lengths))
+            batches = rng.permutation(num_batches)
+        else:
+            order = np.argsort(self.lengths, kind='stable')
+            batches = np.arange(num_batches)
+        self.epoch += 1
+        # repeated from the start so that every rank gets the same number of batches
+        batches = np.resize(batches, len(self) * self.num_replicas)[self.rank::self.num_replicas]
+        for b in batches:
+            yield order[self.bounds[b]:self.bounds[b + 1]].tolist()
+
+    def __len__(self):
+        return -(-(len(self.bounds) - 1) // self.num_replicas)
+
+
+class ResidentLoader(object):
+    """Batches of a SortOfClevr split kept on device, in place of a DataLoader over it.
+
+    The images are copied once to device as one uint8 N x C x H x W tensor, next to the int8 question
+    table. Each epoch, the permutation is drawn on device from seed + epoch, and batches are gathered
+    and scaled to [0, 1] there, with the output of SortOfClevr.__getitems__ (grouped or not).
+    With num_replicas processes, rank takes every num_replicas-th index of the permutation, repeated
+    from the start so that every rank gets the same number, as DistributedSampler does.
+    """
+    sampler = None
+    batch_sampler = None
+
+    def __init__(self, dataset, batch_size, device, shuffle=True, num_replicas=1, rank=0, seed=0):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.device = device
+        self.shuffle = shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.images = torch.from_numpy(dataset.images).to(device).permute(0, 3, 1, 2).contiguous()
+        self.table = torch.from_numpy(dataset.table).to(device)
+        self.generator = torch.Generator(device=device)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batch(self, indices):
+        group_questions = self.dataset.group_questions
+        if not group_questions:
+            rows = self.table[indices].long()
+            return self.images[indices // 48].to(self.dataset.dtype) / 255, rows[:, :2], rows[:, 2]
+        if group_questions < 48:
+            questions = torch.rand(len(indices), 48, generator=self.generator, device=self.device).argsort(1)
+            questions = questions[:, :group_questions].sort(1)[0]
+        else:
+            questions = torch.arange(48, device=self.device).expand(len(indices), 48)
+        rows = self.table[(indices.unsqueeze(1) * 48 + questions).view(-1)].long()
+        image_idx = torch.arange(len(indices), device=self.device).repeat_interleave(group_questions)
+        return self.images[indices].to(self.dataset.dtype) / 255, rows[:, :2], rows[:, 2], image_idx
+
+    def __iter__(self):
+        self.generator.manual_seed(self.seed + self.epoch)
+        self.epoch += 1
+        size = len(self.dataset)
+        if self.shuffle:
+            indices = torch.randperm(size, generator=self.generator, device=self.device)
+        else:
+            indices = torch.arange(size, device=self.device)
+        share = -(-size // self.num_replicas)
+        indices = indices.repeat(-(-share * self.num_replicas // size))[:share * self.num_replicas]
+        for batch_indices in indices[self.rank::self.num_replicas].split(self.batch_size):
+            yield self.batch(batch_indices)
+
+    def __len__(self):
+        share = -(-len(self.dataset) // self.num_replicas)
+        return -(-share // self.batch_size)
+
+
+def shuffled(dataset, dist_config):
+    """DataLoader arguments shuffling dataset, over the share of this rank when dist_config
+    ([world size, rank]) has more than one process."""
+    world_size, rank = dist_config
+    if world_size > 1:
+        return dict(sampler=DistributedSampler(dataset, world_size, rank, shuffle=True))
+    return dict(shuffle=True)
+
+
+def worker_options(loader_config):
+    """DataLoader arguments of loader_config, [workers, pin memory, batches prefetched per worker]."""
+    num_workers, pin_memory, prefetch_factor = loader_config
+    return dict(num_workers=num_workers, pin_memory=pin_memory, prefetch_factor=prefetch_factor if num_workers else None)
+
+
+def reload(loader, loader_config):
+    """loader over the same dataset and batches, with the worker options of loader_config."""
+    if isinstance(loader.dataset, IterableDataset):
+        return DataLoader(loader.dataset, batch_size=loader.batch_size, collate_fn=loader.collate_fn, **worker_options(loader_config))
+    return DataLoader(loader.dataset, batch_sampler=loader.batch_sampler, collate_fn=loader.collate_fn, **worker_options(loader_config))
+
+
+def to_device(batch, device, non_blocking=False):
+    """image, question, answer and image_idx (None outside grouped batches) of a batch, on device."""
+    image, question, answer = batch[:3]
+    image_idx = batch[3].to(device, non_blocking=non_blocking) if len(batch) > 3 else None
+    question = question.to(device, non_blocking=non_blocking)
+    return image.to(device, non_blocking=non_blocking), question, answer.to(device, non_blocking=non_blocking), image_idx
+
+
+def batch_tensors(batch):
+    return [x.data if isinstance(x, PackedSequence) else x for x in batch if x is not None]
+
+
+def pin_batch(batch):
+    """batch with its host tensors in page-locked memory, so that they are copied to cuda asynchronously."""
+    def pin(tensor):
+        return tensor.pin_memory() if tensor.device.type == 'cpu' and not tensor.is_pinned() else tensor
+    return [PackedSequence(pin(x.data), x.batch_sizes, x.sorted_indices, x.unsorted_indices) if isinstance(x, PackedSequence)
+            else pin(x) for x in batch]
+
+
+class Prefetcher(object):
+    """Batches of loader as returned by to_device, loaded and copied to device up to depth batches ahead of
+    the loop by a background thread.
+
+    On cuda, batches are pinned and copied with non-blocking copies on a side stream, and the stream of
+    the loop waits for the copy of a batch when it takes the batch. With depth 0, batches are loaded and
+    copied by the loop. wait is the time the loop spent waiting for batches, stalls the number of batches
+    that were not ready when the loop asked for them.
+    """
+    def __init__(self, loader, device, depth=2):
+        self.loader = loader
+        self.device = device
+        self.depth = depth
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' and depth else None
+        self.wait = 0
+        self.stalls = 0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def stage(self, batch):
+        if self.stream is None:
+            return to_device(batch, self.device), None
+        batch = pin_batch(batch)
+        with torch.cuda.stream(self.stream):
+            batch = to_device(batch, self.device, non_blocking=True)
+            copied = torch.cuda.Event()
+            copied.record(self.stream)
+        return batch, copied
+
+    def produce(self, staged, stop):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    staged.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        try:
+            for batch in self.loader:
+                if not put(self.stage(batch)):
+                    return
+            put(None)
+        except Exception as error:
+            put(error)
+
+    def __iter__(self):
+        if not self.depth:
+            batches = iter(self.loader)
+            while True:
+                start_time = time.time()
+                batch = next(batches, None)
+                if batch is None:
+                    return
+                batch = to_device(batch, self.device)
+                self.wait += time.time() - start_time
+                self.stalls += 1
+                yield batch
+        staged = queue.Queue(self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self.produce, args=(staged, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                start_time = time.time()
+                ready = not staged.empty()
+                item = staged.get()
+                self.wait += time.time() - start_time
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                self.stalls += not ready
+                batch, copied = item
+                if copied is not None:
+                    stream = torch.cuda.current_stream(self.device)
+                    stream.wait_event(copied)
+                    for tensor in batch_tensors(batch):
+                        # the memory of the batch was allocated on the side stream
+                        tensor.record_stream(stream)
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
+
+def train_loader(data, data_directory = home + '/data/', batch_size = 128, data_config=[9800, 200, 75, 5, 3], group_config=[0, 48],
+                 stream_config=[1, 0, 'fixed'], precision='fp32',
+                 bucket_config=[False, 0, 1], dist_config=[1, 0],
+                 loader_config=[0, False, 2], resident_config=[None, 1]):
+    image_dtype = torch.bfloat16 if precision == 'bf16' else torch.float
     if data == 'clevr':
         input_h, input_w, cpu_num = data_config
+        length_bucket, token_budget, seed = bucket_config
+        dataset = Clevr(data_directory + data + '/', train=True, input_size=(input_h, input_w), dtype=image_dtype,
+                        num_workers=cpu_num)
+        if length_bucket:
+            batching = dict(batch_sampler=BucketBatchSampler(np.diff(dataset.offsets), batch_size, token_budget,
+                                                             num_replicas=dist_config[0], rank=dist_config[1], seed=seed))
+        else:
+            batching = dict(batch_size=batch_size, **shuffled(dataset, dist_config))
         train_dataloader = DataLoader(
-            Clevr(data_directory + data + '/', train=True,
-            transform = transforms.Compose([transforms.Resize((input_h, input_w)),
-                                                transforms.ToTensor()])),
-            batch_size=batch_size, shuffle=True,
-            num_workers = cpu_num,
-            collate_fn = collate_text)
+            dataset,
+            collate_fn = collate_items, **batching, **worker_options(loader_config))
     elif data == 'sortofclevr':
         data_config = '_'.join(map(str, data_config))
+        group_images, group_questions = group_config
+        dataset = SortOfClevr(data_directory + data + '/' + data_config + '/', train=True,
+                              group_questions=group_questions if group_images else 0, dtype=image_dtype)
+        resident_device, seed = resident_config
+        if resident_device is not None:
+            train_dataloader = ResidentLoader(dataset, group_images if group_images else batch_size, resident_device,
+                                              num_replicas=dist_config[0], rank=dist_config[1], seed=seed)
+        else:
+            train_dataloader = DataLoader(
+                dataset,
+                batch_size=group_images if group_images else batch_size,
+                collate_fn = collate_items, **shuffled(dataset, dist_config), **worker_options(loader_config))
+    elif data == 'sortofclevr-stream':
+        train_size, test_size, image_size, size, closest = data_config
+        group_images, group_questions = group_config
+        seed, scene_rate, stream_val = stream_config
         train_dataloader = DataLoader(
-            SortOfClevr(data_directory + data + '/' + data_config + '/', train=True),
-            batch_size=batch_size, shuffle=True)
+            SortOfClevrStream(train_size, image_size, size, closest, scene_rate=scene_rate,
+                              group_questions=group_questions if group_images else 0, dtype=image_dtype),
+            batch_size=group_images if group_images else batch_size,
+            collate_fn = collate_group if group_images else None, **worker_options(loader_config))
     return train_dataloader
 
 
-def test_loader(data, data_directory =  home + '/data/', batch_size = 12, data_config=[9800, 200, 75, 5, 3]):
+def test_loader(data, data_directory =  home + '/data/', batch_size = 12, data_config=[9800, 200, 75, 5, 3], group_config=[0, 48],
+                stream_config=[1, 0, 'fixed'], precision='fp32', bucket_config=[False, 0, 1], dist_config=[1, 0],
+                loader_config=[0, False, 2], resident_config=[None, 1]):
+    image_dtype = torch.bfloat16 if precision == 'bf16' else torch.float
     if data == 'clevr':
         input_h, input_w, cpu_num = data_config
+        length_bucket, token_budget, seed = bucket_config
+        dataset = Clevr(data_directory + data + '/', train=False, input_size=(input_h, input_w), dtype=image_dtype,
+                        num_workers=cpu_num)
+        if length_bucket:
+            batching = dict(batch_sampler=BucketBatchSampler(np.diff(dataset.offsets), batch_size, token_budget,
+                                                             num_replicas=dist_config[0], rank=dist_config[1], seed=seed))
+        else:
+            batching = dict(batch_size=batch_size, **shuffled(dataset, dist_config))
         test_dataloader = DataLoader(
-            Clevr(data_directory + data + '/', train=False,
-            transform = transforms.Compose([transforms.Resize((input_h, input_w)),
-                                                transforms.ToTensor()])),
-            batch_size=batch_size, shuffle=True,
-            num_workers = cpu_num,
-            collate_fn = collate_text)
+            dataset,
+            collate_fn = collate_items, **batching, **worker_options(loader_config))
     elif data == 'sortofclevr':
         data_config = '_'.join(map(str, data_config))
+        group_images, group_questions = group_config
+        dataset = SortOfClevr(data_directory + data + '/' + data_config + '/', train=False,
+                              group_questions=group_questions if group_images else 0, dtype=image_dtype)
+        resident_device, seed = resident_config
+        if resident_device is not None:
+            test_dataloader = ResidentLoader(dataset, group_images if group_images else batch_size, resident_device,
+                                              num_replicas=dist_config[0], rank=dist_config[1], seed=seed)
+        else:
+            test_dataloader = DataLoader(
+                dataset,
+                batch_size=group_images if group_images else batch_size,
+                collate_fn = collate_items, **shuffled(dataset, dist_config), **worker_options(loader_config))
+    elif data == 'sortofclevr-stream':
+        train_size, test_size, image_size, size, closest = data_config
+        group_images, group_questions = group_config
+        seed, scene_rate, stream_val = stream_config
+        if stream_val == 'fixed':
+            dataset = SortOfClevrStream(test_size, image_size, size, closest, seed=seed,
+                                        group_questions=group_questions if group_images else 0, dtype=image_dtype)
+            collate = collate_group if group_images else None
+        else:
+            dataset = SortOfClevr(data_directory + 'sortofclevr/' + '_'.join(map(str, data_config)) + '/', train=False,
+                                  group_questions=group_questions if group_images else 0, dtype=image_dtype)
+            collate = collate_items
         test_dataloader = DataLoader(
-            SortOfClevr(data_directory + data + '/' + data_config + '/', train=False),
-            batch_size=batch_size, shuffle=True)
+            dataset,
+            batch_size=group_images if group_images else batch_size,
+            collate_fn = collate)
     return test_dataloader
 
 
+def load_resized(img_dir, input_size, filename):
+    """Pool worker: one CLEVR image decoded and resized as transforms.Resize does, as H x W x 3 uint8."""
+    image = Image.open(img_dir + filename).convert('RGB')
+    return np.asarray(transforms.Resize(input_size)(image))
+
+
+def iter_json_array(path, key, chunk_size=2 ** 20):
+    """Yields the elements of the array under key in the JSON object of path one at a time, reading
+    chunk_size characters at a time instead of decoding the whole file."""
+    decoder = json.JSONDecoder()
+    separators = re.compile(r'[\s,]*')
+    with open(path) as file:
+        buffer = ''
+        start = -1
+        while start < 0:
+            more = file.read(chunk_size)
+            if not more:
+                raise ValueError('no array "{}" in {}'.format(key, path))
+            buffer += more
+            start = buffer.find('"{}"'.format(key))
+            if start >= 0:
+                start = buffer.find('[', start)
+        pos = start + 1
+        while True:
+            pos = separators.match(buffer, pos).end()
+            if pos < len(buffer) and buffer[pos] == ']':
+                return
+            try:
+                element, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                more = file.read(chunk_size)
+                if not more:
+                    raise
+                buffer = buffer[pos:] + more
+                pos = 0
+                continue
+            yield element
+            pos = end
+
+
+def sorted_rank(ids):
+    """Sorted keys of a key -> id dict, with the array mapping each id to the position of its key."""
+    keys = sorted(ids)
+    rank = np.empty(len(keys), dtype=np.int64)
+    rank[[ids[key] for key in keys]] = np.arange(len(keys))
+    return rank, keys
+
+
 class Clevr(Dataset):
-    """Clevr dataset."""
-    def __init__(self, root_dir, train = True, transform = None):
+    """Clevr dataset.
+
+    With input_size set, images are read from a uint8 N x H x W x 3 .npy of the split resized to
+    input_size (images_{split}_{h}x{w}.npy, with the filename of each row in the matching .json),
+    opened as a memory map. It is written by make_images on first use, so that each PNG is
+    decoded once instead of once per question and epoch.
+    After use_features, items carry the conv outputs of their image instead of the image.
+    Questions are read from the flat columns written by make_data, opened as memory maps.
+    """
+    def __init__(self, root_dir, train = True, transform = None, input_size = None, dtype = torch.float, num_workers = 0):
         self.root_dir = root_dir
         # self.mode = 'sample'
         self.mode = 'train' if train else 'val'
         self.transform = transform
+        self.input_size = input_size
+        self.dtype = dtype
         self.q_dir = self.root_dir + 'questions/'+ 'CLEVR_{}_questions.json'.format(self.mode)
         self.img_dir = self.root_dir + 'images/'+ '{}/'.format(self.mode)
+        image_mode = self.mode
         if self.mode == 'sample':
             self.img_dir = self.root_dir + 'images/train/'
+            image_mode = 'train'
+        self.image_mode = image_mode
         self.load_data()
+        self.images = None
+        self.features = None
+        if input_size is not None:
+            self.cache_dir = self.root_dir + 'images_{}_{}x{}'.format(image_mode, *input_size)
+            if not os.path.exists(self.cache_dir + '.npy'):
+                self.make_images(num_workers)
+            self.load_images()
 
     def make_data(self):
-        q_corpus = set()
-        a_corpus = set()
-        modes = ['train', 'val', 'sample']
-        q_list = dict()
-        qa_list = defaultdict(list)
+        """Tokenizes the question files of every split, streamed one question at a time, into flat columns:
+        questions_{split}_tokens.npy (int32, with SOS and EOS), questions_{split}_offsets.npy (int64, the
+        tokens of question i are tokens[offsets[i]:offsets[i + 1]]), questions_{split}_answers.npy (int16) and
+        questions_{split}_images.npy (int32 index into questions_{split}_filenames.json).
+        Words and answers are numbered in sorted order, saved in vocab.json."""
+        modes = [mode for mode in ['train', 'val', 'sample']
+                 if os.path.exists(self.root_dir + 'questions/CLEVR_{}_questions.json'.format(mode))]
+        words, answer_words = dict(), dict()
+        columns = dict()
         for mode in modes:
-            img_dir = self.root_dir + 'images/{}/'.format(mode)
-            if mode == 'sample':
-                img_dir = self.root_dir + 'images/train/'
+            tokens, offsets, answers, image_idx = array('i'), array('q', [0]), array('i'), array('i')
+            filenames = dict()
             ann_dir = self.root_dir + 'questions/CLEVR_{}_questions.json'.format(mode)
-            with open(self.root_dir + ann_dir) as f:
-                q_list[mode] = json.load(f)['questions']
-            for q_obj in q_list[mode]:
-                img_dir = q_obj['image_filename']
-                q_text = q_obj['question'].lower()
-                q_text = re.sub('\s+', ' ', q_text)
-                q_text_without_question_mark = q_text[:-1]
-                q_words = q_text_without_question_mark.split(' ')
-                q_corpus.update(q_words)
-                a_text = q_obj['answer'].lower()
-                a_text = re.sub('\s+', ' ', a_text)
-                a_corpus.add(a_text)
-                qa_list[mode].append((img_dir, q_words, a_text))
-
-        word_to_idx = {"PAD":0, "SOS": 1, "EOS": 2}
-        idx_to_word = {0: "PAD", 1: "SOS", 2: "EOS"}
-        answer_word_to_idx = dict()
-        answer_idx_to_word = dict()
-        for idx, word in enumerate(q_corpus, start=3):
-            # index starts with 1 because 0 is used as the padded value when batches are
-            #  created
-            word_to_idx[word] = idx
-            idx_to_word[idx] = word
-
-        for idx, word in enumerate(a_corpus):
-            answer_word_to_idx[word] = idx
-            answer_idx_to_word[idx] = word
-        #     # single answer, so no padded values of 0 are created. thus index starts with 0
-        data_dict = {'question': {'word_to_idx' : word_to_idx,
-                                    'idx_to_word' : idx_to_word},
-                        'answer': {'word_to_idx' : answer_word_to_idx,
-                                    'idx_to_word' : answer_idx_to_word}}
-        with open(self.root_dir + 'data_dict.pkl', 'wb') as file:
-            pickle.dump(data_dict, file, protocol=pickle.HIGHEST_PROTOCOL)
-        print('data_dict.pkl saved')
-
-        qa_idx_data = defaultdict(list)
+            for q_obj in iter_json_array(ann_dir, 'questions'):
+                q_text = re.sub('\s+', ' ', q_obj['question'].lower())
+                tokens.extend(words.setdefault(word, len(words)) for word in q_text[:-1].split(' '))
+                offsets.append(len(tokens))
+                a_text = re.sub('\s+', ' ', q_obj['answer'].lower())
+                answers.append(answer_words.setdefault(a_text, len(answer_words)))
+                image_idx.append(filenames.setdefault(q_obj['image_filename'], len(filenames)))
+            columns[mode] = (np.frombuffer(tokens, dtype=np.int32), np.frombuffer(offsets, dtype=np.int64),
+                             np.frombuffer(answers, dtype=np.int32), np.frombuffer(image_idx, dtype=np.int32), filenames)
+            print('{} questions of {} read'.format(len(answers), ann_dir))
+
+        # ids are assigned in order of appearance above and renumbered to the sorted order here
+        word_rank, word_list = sorted_rank(words)
+        answer_rank, answer_list = sorted_rank(answer_words)
+        with open(self.root_dir + 'vocab.json', 'w') as file:
+            json.dump({'question': ['PAD', 'SOS', 'EOS'] + word_list, 'answer': answer_list}, file)
         for mode in modes:
-            for img_dir, q_word_list, answer_word in qa_list[mode]:
-                q = [word_to_idx[word] for word in q_word_list]
-                q.insert(0, 1)
-                q.append(2)
-                q = torch.from_numpy(np.array(q))
-                a = answer_word_to_idx[answer_word]
-                a = torch.from_numpy(np.array(a)).view(1)
-                qa_idx_data[mode].append((img_dir, q, a))
-            with open(self.root_dir + 'qa_idx_data_{}.pkl'.format(mode), 'wb') as file:
-                pickle.dump(qa_idx_data[mode], file, protocol=pickle.HIGHEST_PROTOCOL)
-            print('qa_idx_data_{}.pkl saved'.format(mode))
+            tokens, offsets, answers, image_idx, filenames = columns[mode]
+            filename_rank, filename_list = sorted_rank(filenames)
+            n = len(answers)
+            # SOS and EOS around each question
+            q_offsets = offsets + 2 * np.arange(n + 1)
+            q_tokens = np.empty(q_offsets[-1], dtype=np.int32)
+            q_tokens[q_offsets[:-1]] = 1
+            q_tokens[q_offsets[1:] - 1] = 2
+            body = np.ones(q_offsets[-1], dtype=bool)
+            body[q_offsets[:-1]] = False
+            body[q_offsets[1:] - 1] = False
+            q_tokens[body] = word_rank[tokens] + 3
+            column_dir = self.root_dir + 'questions_{}_{{}}'.format(mode)
+            np.save(column_dir.format('tokens.npy'), q_tokens)
+            np.save(column_dir.format('offsets.npy'), q_offsets)
+            np.save(column_dir.format('answers.npy'), answer_rank[answers].astype(np.int16))
+            np.save(column_dir.format('images.npy'), filename_rank[image_idx].astype(np.int32))
+            with open(column_dir.format('filenames.json'), 'w') as file:
+                json.dump(filename_list, file)
+            print('questions_{}_*.npy saved'.format(mode))
 
     def load_data(self):
-        with open(self.root_dir + 'qa_idx_data_{}.pkl'.format(self.mode), 'rb') as file:
-            self.qa_idx_data = pickle.load(file)
-        with open(self.root_dir + 'data_dict.pkl', 'rb') as file:
-            self.data_dict = pickle.load(file)
-        self.word_to_idx = self.data_dict['question']['word_to_idx']
-        self.idx_to_word = self.data_dict['question']['idx_to_word']
-        self.answer_word_to_idx = self.data_dict['answer']['word_to_idx']
-        self.answer_idx_to_word = self.data_dict['answer']['idx_to_word']
+        column_dir = self.root_dir + 'questions_{}_{{}}'.format(self.mode)
+        if not (os.path.exists(self.root_dir + 'vocab.json') and os.path.exists(column_dir.format('filenames.json'))):
+            self.make_data()
+        self.tokens = np.load(column_dir.format('tokens.npy'), mmap_mode='c')
+        self.offsets = np.load(column_dir.format('offsets.npy'), mmap_mode='c')
+        self.answers = np.load(column_dir.format('answers.npy'), mmap_mode='c')
+        self.image_idx = np.load(column_dir.format('images.npy'), mmap_mode='c')
+        with open(column_dir.format('filenames.json')) as file:
+            self.filenames = json.load(file)
+        with open(self.root_dir + 'vocab.json') as file:
+            vocab = json.load(file)
+        self.word_to_idx = {word: idx for idx, word in enumerate(vocab['question'])}
+        self.idx_to_word = dict(enumerate(vocab['question']))
+        self.answer_word_to_idx = {word: idx for idx, word in enumerate(vocab['answer'])}
+        self.answer_idx_to_word = dict(enumerate(vocab['answer']))
         self.q_size = len(self.word_to_idx)
         self.a_size = len(self.answer_word_to_idx)
 
+    def make_images(self, num_workers=0):
+        filenames = sorted(f for f in os.listdir(self.img_dir) if f.endswith('.png'))
+        print('Resizing {} images of {} to {}x{}'.format(len(filenames), self.img_dir, *self.input_size))
+        with open(self.cache_dir + '.json', 'w') as file:
+            json.dump(filenames, file)
+        # written under a temporary name, so that an interrupted run does not leave a partial cache
+        images = np.lib.format.open_memmap(self.cache_dir + '.tmp', mode='w+', dtype=np.uint8,
+                                           shape=(len(filenames),) + tuple(self.input_size) + (3,))
+        with Pool(num_workers or None) as pool:
+            for n, image in enumerate(pool.imap(partial(load_resized, self.img_dir, tuple(self.input_size)), filenames, chunksize=64)):
+                images[n] = image
+        images.flush()
+        del images
+        os.replace(self.cache_dir + '.tmp', self.cache_dir + '.npy')
+        print('{}.npy saved'.format(self.cache_dir))
+
+    def load_images(self):
+        self.images = np.load(self.cache_dir + '.npy', mmap_mode='c')
+        with open(self.cache_dir + '.json') as file:
+            image_row = {filename: n for n, filename in enumerate(json.load(file))}
+        # cache row of each entry of self.filenames
+        self.image_rows = np.array([image_row[filename] for filename in self.filenames])
+
+    def use_features(self, network, device, batch_size=64):
+        """Serves network.encode_image of each image, computed once into an fp16 .npy keyed by the
+        input size and a digest of the conv weights, so that a frozen trunk is not rerun per question."""
+        if self.images is None:
+            raise ValueError('use_features needs the image cache of an input_size')
+        digest = hashlib.sha1()
+        for name, tensor in network.conv.state_dict().items():
+            digest.update(name.encode())
+            digest.update(tensor.detach().cpu().numpy().tobytes())
+        feature_dir = self.root_dir + 'features_{}_{}x{}_{}.npy'.format(self.image_mode, *self.input_size, digest.hexdigest()[:12])
+        if not os.path.exists(feature_dir):
+            self.make_features(network, device, batch_size, feature_dir)
+        self.features = np.load(feature_dir, mmap_mode='c')
+
+    def make_features(self, network, device, batch_size, feature_dir):
+        print('Encoding {} images of {} with the frozen conv'.format(len(self.images), self.img_dir))
+        training = network.training
+        network.eval()
+        features = None
+        with torch.no_grad():
+            for start in range(0, len(self.images), batch_size):
+                images = torch.from_numpy(self.images[start:start + batch_size].transpose(0, 3, 1, 2)).to(device, torch.float) / 255
+                objects = network.encode_image(images).half().cpu().numpy()
+                if features is None:
+                    features = np.lib.format.open_memmap(feature_dir + '.tmp', mode='w+', dtype=np.float16,
+                                                         shape=(len(self.images),) + objects.shape[1:])
+                features[start:start + len(objects)] = objects
+        network.train(training)
+        features.flush()
+        del features
+        os.replace(feature_dir + '.tmp', feature_dir)
+        print('{} saved'.format(feature_dir))
+
     def __len__(self):
-        return len(self.qa_idx_data)
+        return len(self.answers)
 
     def __getitem__(self, idx):
-
-        img_dir, q, a = self.qa_idx_data[idx]
-        image = Image.open(self.img_dir + img_dir).convert('RGB')
+        q = torch.from_numpy(self.tokens[self.offsets[idx]:self.offsets[idx + 1]].astype(np.int64))
+        a = torch.tensor([self.answers[idx]], dtype=torch.long)
+        if self.features is not None:
+            return torch.from_numpy(self.features[self.image_rows[self.image_idx[idx]]]).to(self.dtype), q, a
+        if self.images is not None:
+            image = torch.from_numpy(self.images[self.image_rows[self.image_idx[idx]]].transpose(2, 0, 1)).to(self.dtype) / 255
+            return image, q, a
+        image = Image.open(self.img_dir + self.filenames[self.image_idx[idx]]).convert('RGB')
         if self.transform:
             image = self.transform(image)
         return image, q, a
 
+    def __getitems__(self, indices):
+        """The batch of collate_text, gathered from the columns and the image or feature cache."""
+        if self.images is None:
+            return collate_text([self[idx] for idx in indices])
+        indices = np.asarray(indices)
+        lengths = self.offsets[indices + 1] - self.offsets[indices]
+        order = np.argsort(-lengths, kind='stable')
+        indices, lengths = indices[order], lengths[order]
+        steps = np.arange(lengths[0])
+        mask = steps < lengths[:, None]
+        questions = new_batch(torch.empty(0, dtype=torch.long), (len(indices), lengths[0])).zero_()
+        questions[torch.from_numpy(mask)] = torch.from_numpy(self.tokens[(self.offsets[indices][:, None] + steps)[mask]].astype(np.int64))
+        answers = torch.from_numpy(self.answers[indices].astype(np.int64))
+        rows = self.image_rows[self.image_idx[indices]]
+        if self.features is not None:
+            images = torch.from_numpy(self.features[rows]).to(self.dtype)
+        else:
+            images = images_batch(self.images[rows], self.dtype)
+        return images, pack_padded_sequence(questions, torch.from_numpy(lengths), batch_first=True), answers
+
 
 class SortOfClevr(Dataset):
-    """SortOfClevr dataset."""
-    def __init__(self, root_dir, train = True, transform = None):
+    """SortOfClevr dataset.
+
+    Reads the columnar .npy files written by sort_of_clevr_generator (uint8 images, int8 questions
+    and answers) as memory maps, and falls back to converting the legacy pickle.
+    Question idx is row idx of an int8 (color, question type, answer) table, on image idx // 48.
+    __getitems__ gathers a whole batch with array indexing; its output is already collated (see collate_items).
+    With group_questions set, an item is one image together with group_questions of its 48
+    questions, so that the image is decoded and encoded once per batch (see collate_group).
+    """
+    def __init__(self, root_dir, train = True, transform = None, group_questions = 0, dtype = torch.float):
         self.root_dir = root_dir
         self.mode = 'train' if train else 'val'
         self.transform = transform
+        self.group_questions = group_questions
+        self.dtype = dtype
         self.data_dir = self.root_dir + 'sort-of-clevr-{}.pickle'.format(self.mode)
+        self.column_dir = self.root_dir + 'sort-of-clevr-{}-{{}}.npy'.format(self.mode)
         self.load_data()
 
     def load_data(self):
-        with open(self.data_dir, 'rb') as f:
-            self.data = pickle.load(f)
+        if os.path.exists(self.column_dir.format('images')):
+            # copy-on-write maps give writable arrays to torch.from_numpy without touching the files
+            self.images = np.load(self.column_dir.format('images'), mmap_mode='c')
+            self.questions = np.load(self.column_dir.format('questions'), mmap_mode='c')
+            self.answers = np.load(self.column_dir.format('answers'), mmap_mode='c')
+        else:
+            with open(self.data_dir, 'rb') as f:
+                self.images, self.questions, self.answers = sort_of_clevr_generator.to_columns(pickle.load(f))
         self.idx_to_color = sort_of_clevr_generator.color_dict
         self.idx_to_question = sort_of_clevr_generator.question_type_dict
         self.idx_to_answer = sort_of_clevr_generator.answer_dict
         self.c_size = len(self.idx_to_color)
         self.q_size = len(self.idx_to_question)
         self.a_size = len(self.idx_to_answer)
+        self.questions_per_item = self.group_questions if self.group_questions else 1
+        self.table = np.concatenate([self.questions.reshape(-1, 2), self.answers.reshape(-1, 1)], 1).astype(np.int8)
 
     def __len__(self):
-        return len(self.data * 48)
+        if self.group_questions:
+            return len(self.images)
+        return len(self.images) * 48
 
     def __getitem__(self, idx):
-        image, rel, non_rel = self.data[idx//48]
-        # print(image)
-        # image = transforms.toTensor(image)
-        index = idx % 48
-        if index < 18:
-            q, a = non_rel
-            q = q[index]
-            a = a[index]
-            q = np.where(q)[0]
-            q[1] = q[2] - 8
-            q = q[:2]
+        if self.group_questions:
+            if self.group_questions < 48:
+                indices = np.sort(np.random.choice(48, self.group_questions, replace=False))
+            else:
+                indices = slice(None)
+            image = torch.from_numpy(self.images[idx].transpose(2, 0, 1)).to(self.dtype) / 255
+            q = torch.from_numpy(self.questions[idx, indices]).long()
+            a = torch.from_numpy(self.answers[idx, indices]).long()
+            return image, q, a
+        image = torch.from_numpy(self.images[idx // 48].transpose(2, 0, 1)).to(self.dtype) / 255
+        q = torch.from_numpy(self.table[idx, :2]).long()
+        a = int(self.table[idx, 2])
+        return image, q, a
+
+    def __getitems__(self, indices):
+        indices = np.asarray(indices)
+        if self.group_questions:
+            # the batch of collate_group
+            if self.group_questions < 48:
+                questions = np.sort(np.stack([np.random.choice(48, self.group_questions, replace=False) for _ in indices]), 1)
+            else:
+                questions = np.broadcast_to(np.arange(48), (len(indices), 48))
+            rows = torch.from_numpy(self.table[(indices[:, None] * 48 + questions).reshape(-1)]).long()
+            image_idx = torch.arange(len(indices)).repeat_interleave(self.group_questions)
+            return images_batch(self.images[indices], self.dtype), rows[:, :2], rows[:, 2], image_idx
+        rows = torch.from_numpy(self.table[indices]).long()
+        return images_batch(self.images[indices // 48], self.dtype), rows[:, :2], rows[:, 2]
 
+class SortOfClevrStream(IterableDataset):
+    """SortOfClevr scenes rendered on the fly by sort_of_clevr_generator.build_scenes.
+
+    Without seed, every pass draws scene_size fresh scenes, split among the DataLoader workers,
+    each rendering from its own worker seed. With seed, scene_size scenes are rendered once
+    and served on every pass (a fixed validation set). scene_rate caps the scenes rendered
+    per second over all workers, 0 for no limit.
+    """
+    def __init__(self, scene_size, img_size, size, closest, seed = None, scene_rate = 0, chunk_size = 64,
+                 group_questions = 0, dtype = torch.float):
+        self.scene_size = scene_size
+        self.img_size = img_size
+        self.size = size
+        self.closest = closest
+        self.seed = seed
+        self.scene_rate = scene_rate
+        self.chunk_size = chunk_size
+        self.group_questions = group_questions
+        self.dtype = dtype
+        self.questions = torch.from_numpy(sort_of_clevr_generator.scene_questions()).long()
+        if self.seed is not None:
+            self.images, self.answers = sort_of_clevr_generator.build_scenes(
+                np.random.default_rng(self.seed), self.scene_size, self.img_size, self.size, self.closest)
+        self.idx_to_color = sort_of_clevr_generator.color_dict
+        self.idx_to_question = sort_of_clevr_generator.question_type_dict
+        self.idx_to_answer = sort_of_clevr_generator.answer_dict
+        self.c_size = len(self.idx_to_color)
+        self.q_size = len(self.idx_to_question)
+        self.a_size = len(self.idx_to_answer)
+        self.questions_per_item = self.group_questions if self.group_questions else 1
+
+    def __len__(self):
+        if self.group_questions:
+            return self.scene_size
+        return self.scene_size * 48
+
+    def scenes(self, rng, worker_id, num_workers):
+        if self.seed is not None:
+            indices = np.arange(worker_id, self.scene_size, num_workers)
+            for start in range(0, len(indices), self.chunk_size):
+                chunk = indices[start:start + self.chunk_size]
+                yield self.images[chunk], self.answers[chunk]
+            return
+        scene_size = len(range(worker_id, self.scene_size, num_workers))
+        start_time = time.time()
+        for start in range(0, scene_size, self.chunk_size):
+            chunk_size = min(self.chunk_size, scene_size - start)
+            yield sort_of_clevr_generator.build_scenes(rng, chunk_size, self.img_size, self.size, self.closest)
+            if self.scene_rate:
+                wait = start_time + (start + chunk_size) * num_workers / self.scene_rate - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers = 0, 1
+            worker_seed = torch.empty((), dtype=torch.int64).random_().item()
         else:
-            q, a = rel
-            q = q[index - 18]
-            a = a[index - 18]
-            q = np.where(q)[0]
-            q[1] = q[2] - 5
-            q = q[:2]
-        image = torch.from_numpy(image.transpose(2, 0, 1)).float() / 255
-
-        q = torch.from_numpy(q).long()
-        return image, q, a
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+            worker_seed = worker_info.seed
+        rng = np.random.default_rng(worker_seed)
+        for images, answers in self.scenes(rng, worker_id, num_workers):
+            images = torch.from_numpy(images.transpose(0, 3, 1, 2)).to(self.dtype) / 255
+            answers = torch.from_numpy(answers).long()
+            if self.group_questions:
+                for n in rng.permutation(len(images)):
+                    indices = torch.from_numpy(np.sort(rng.choice(48, self.group_questions, replace=False)))
+                    yield images[n], self.questions[indices], answers[n, indices]
+            else:
+                for index in rng.permutation(len(images) * 48):
+                    yield images[index // 48], self.questions[index % 48], answers[index // 48, index % 48].item()
 
 if __name__ =='__main__':
     debug()
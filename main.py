@@ -1,111 +1,103 @@
 import os
+import json
 import time
 import torch.optim as optim
-from torch.nn.utils.rnn import PackedSequence, pad_packed_sequence
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.nn.utils.rnn import pad_packed_sequence
 from tensorboardX import SummaryWriter
 from build_model import build_model
 from utils import *
-from collections import defaultdict
 import cv2
+from metrics import Metrics
 from configuration import get_config
 import dataloader
+import autotune
+import profiling
 
 args = get_config()
 device = args.device
+if args.threads:
+    torch.set_num_threads(args.threads)
 
-train_loader = dataloader.train_loader(args.dataset, args.data_directory, args.batch_size, args.data_config)
-test_loader = dataloader.test_loader(args.dataset, args.data_directory, args.batch_size, args.data_config)
+if args.distributed:
+    dist.init_process_group('gloo')
+    if args.rank > 0:
+        # dataset files and caches are written by rank 0 first
+        dist.barrier()
+
+train_loader = dataloader.train_loader(args.dataset, args.data_directory, args.batch_size, args.data_config, args.group_config, args.stream_config, args.precision, args.bucket_config, args.dist_config, args.loader_config, args.resident_config)
+test_loader = dataloader.test_loader(args.dataset, args.data_directory, args.batch_size, args.data_config, args.group_config, args.stream_config, args.precision, args.bucket_config, args.dist_config, args.loader_config, args.resident_config)
 args.label_size = train_loader.dataset.a_size
 args.q_size = train_loader.dataset.q_size
-args.c_size = train_loader.dataset.c_size
+args.c_size = getattr(train_loader.dataset, 'c_size', 1)
 
-models = build_model(args)
+network = build_model(args)
 
 if args.load_model != '000000000000':
-    for model_name, model in models.items():
+    for model_name, model in network.module_files().items():
         model.load_state_dict(torch.load(os.path.join(args.log_directory + args.project, args.load_model, model_name)))
     args.time_stamp = args.load_model[:12]
     print('Model {} loaded.'.format(args.load_model))
+if args.load_conv:
+    network.conv.load_state_dict(torch.load(os.path.join(args.log_directory + args.project, args.load_conv, 'conv.pt')))
+    print('Conv {} loaded.'.format(args.load_conv))
+if args.text_cache:
+    network.cache_text(args.text_cache)
+if args.feature_cache:
+    network.freeze_conv()
+    train_loader.dataset.use_features(network, device)
+    test_loader.dataset.use_features(network, device)
+if args.distributed:
+    if args.rank == 0:
+        dist.barrier()
+    # same initial weights on every rank from build_model, different dropout
+    torch.manual_seed(args.seed + args.rank)
+
+# static graph: the same parameters are used every step, though not all of them (MultiHeadAttention.layer_norm)
+step_network = DistributedDataParallel(network, static_graph=True) if args.distributed else network
+step_network = torch.compile(step_network) if args.compile else step_network
 
 
 def epoch(epoch_idx, is_train):
     epoch_start_time = time.time()
     start_time = time.time()
     mode = 'Train' if is_train else 'Test'
-    epoch_loss = 0
-    q_correct = defaultdict(lambda: 0)
-    q_num = defaultdict(lambda: 0)
+    metrics = Metrics(args.c_size, args.q_size if args.c_size > 1 else 1, device)
     if is_train:
-        for model in models.values():
-            model.train()
+        step_network.train()
         loader = train_loader
     else:
-        for model in models.values():
-            model.eval()
+        step_network.eval()
         loader = test_loader
-    for batch_idx, (image, question, answer) in enumerate(loader):
-        batch_size = image.size()[0]
+    for sampler in [loader, loader.sampler, loader.batch_sampler]:
+        if hasattr(sampler, 'set_epoch'):
+            sampler.set_epoch(epoch_idx)
+    data_size = len(loader.dataset) * getattr(loader.dataset, 'questions_per_item', 1)
+    batches = dataloader.Prefetcher(loader, device, args.prefetch_depth)
+    profiler.reset()
+    for batch_idx, (image, question, answer, image_idx) in enumerate(batches):
+        batch_size = answer.size()[0]
         optimizer.zero_grad()
-        image = image.to(device)
-        answer = answer.to(device)
-        if args.dataset == 'clevr':
-            question = PackedSequence(question.data.to(device), question.batch_sizes)
-        else:
-            question = question.to(device)
-            # answer = answer.squeeze(1)
-        code = models['text_encoder.pt'](question)
-        if args.model == 'baseline':
-            objects = models['conv.pt'](image * 2 - 1)
-            pairs = baseline_encode(objects, code)
-            relations = models['g_theta.pt'](pairs)
-            relations = relations.sum(1)
-            output = models['f_phi.pt'](relations)
-        elif args.model == 'rn':
-            objects = models['conv.pt'](image * 2 - 1)
-            pairs = rn_encode(objects, code)
-            relations = models['g_theta.pt'](pairs)
-            relations = lower_sum(relations)
-            relations = relations.sum(1)
-            output = models['f_phi.pt'](relations)
-        elif args.model == 'sarn':
-            objects = models['conv.pt'](image * 2 - 1)
-            coordinate_encoded, question_encoded = sarn_encode(objects, code)
-            logits = models['h_psi.pt'](question_encoded)
-            pairs = sarn_pair(coordinate_encoded, question_encoded, logits)
-            relations = models['g_theta.pt'](pairs)
-            relations = relations.sum(1)
-            output = models['f_phi.pt'](relations)
-        elif args.model == 'sarn_att':
-            objects = models['conv.pt'](image * 2 - 1)
-            coordinate_encoded, question_encoded = sarn_encode(objects, code)
-            logits = models['h_psi.pt'](question_encoded)
-            selected = sarn_select(coordinate_encoded, logits)
-            relations, att = models['attn.pt'](selected, coordinate_encoded, coordinate_encoded)
-            relations = models['g_theta.pt'](relations)
-            relations = relations.sum(1)
-            output = models['f_phi.pt'](relations)
-        elif args.model == 'new':
-            relations = models['conv.pt'](image * 2 - 1, code)
-            output = models['f_phi.pt'](relations)
-        elif args.model == 'film':
-            objects = models['conv.pt'](image * 2 - 1)
-            output = models['film.pt'](objects, code)
-        loss = F.cross_entropy(output, answer)
+        with profiler.section('forward', 'loss'), torch.autocast(device.type, dtype=torch.bfloat16, enabled=args.precision == 'bf16'):
+            output = step_network(image, question, image_idx)
+            loss = F.cross_entropy(output, answer)
         if is_train:
-            loss.backward()
-            optimizer.step()
-        epoch_loss += loss.item()
+            with profiler.section('backward', 'loss'):
+                loss.backward()
+            with profiler.section('optimizer'):
+                optimizer.step()
+        profiler.step()
         pred = torch.max(output.data, 1)[1]
         correct = (pred == answer)
-        for i in range(args.q_size):
-            idx = question[:, 1] == i
-            q_correct[i] += (correct * idx).sum().item()
-            q_num[i] += idx.sum().item()
+        metrics.update(loss, correct, question)
+        if args.rank > 0:
+            continue
         if is_train:
             if batch_idx % args.log_interval == 0:
                 print('Train Batch: {} [{}/{} ({:.0f}%)] Loss: {:.4f} / Time: {:.4f} / Acc: {:.4f}'.format(
                     epoch_idx,
-                    batch_idx * batch_size, len(loader.dataset),
+                    batch_idx * batch_size, data_size,
                     100. * batch_idx / len(loader),
                     loss.item() / batch_size,
                     time.time() - start_time,
@@ -127,13 +119,16 @@ def epoch(epoch_idx, is_train):
                     text = []
                     for j, (q, a) in enumerate(zip(question_text, answer_text)):
                         text.append('Quesetion {}: '.format(j) + question_text[j] + '/ Answer: ' + answer_text[j])
-                    writer.add_image('Image', torch.cat([image[:n]]), epoch_idx)
+                    if not network.precomputed:
+                        writer.add_image('Image', torch.cat([image[:n]]).float(), epoch_idx)
                     writer.add_text('QA', '\n'.join(text), epoch_idx)
                 else:
+                    if image_idx is not None:
+                        image = image.index_select(0, image_idx[:n])
                     image = F.pad(image[:n], (0, 0, 0, args.input_h // 3), mode='constant', value=1).transpose(1,
                                                                                                                2).transpose(
                         2, 3)
-                    image = image.cpu().numpy()
+                    image = image.float().cpu().numpy()
                     for i in range(n):
                         cv2.line(image[i], (args.input_w // 2, 0), (args.input_w // 2, args.input_h), (0, 0, 0), 1)
                         cv2.line(image[i], (0, args.input_h // 2), (args.input_w, args.input_h // 2), (0, 0, 0), 1)
@@ -147,31 +142,75 @@ def epoch(epoch_idx, is_train):
                     image = torch.from_numpy(image).transpose(2, 3).transpose(1, 2)
                     writer.add_image('Image', torch.cat([image]), epoch_idx)
 
-    print('====> {}: {} Average loss: {:.4f} / Time: {:.4f} / Accuracy: {:.4f}'.format(
+    epoch_time = time.time() - epoch_start_time
+    if args.distributed:
+        metrics.all_reduce()
+        if args.rank > 0:
+            return
+    epoch_loss = metrics.loss()
+    tally = metrics.tally()
+    q_correct = tally[:, :, 1].sum(0)
+    q_num = tally.sum((0, 2))
+    # questions answered by all processes, including those repeated to even out the shares of the ranks
+    data_size = int(q_num.sum())
+    print('====> {}: {} Average loss: {:.4f} / Time: {:.4f} / Throughput: {:.1f} / Accuracy: {:.4f}'.format(
         mode,
         epoch_idx,
-        epoch_loss / len(loader.dataset),
-        time.time() - epoch_start_time,
-        sum(q_correct.values()) / len(loader.dataset)))
-    writer.add_scalar('{} loss'.format(mode), epoch_loss / len(loader.dataset), epoch_idx)
-    q_acc = {}
-    for i in range(args.q_size):
-        q_acc['question {}'.format(str(i))] = q_correct[i] / q_num[i]
-    q_corrects = list(q_correct.values())
-    q_nums = list(q_num.values())
-    writer.add_scalars('{} accuracy per question'.format(mode), q_acc, epoch_idx)
-    writer.add_scalar('{} non-rel accuracy'.format(mode), sum(q_corrects[:3]) / sum(q_nums[:3]), epoch_idx)
-    writer.add_scalar('{} rel accuracy'.format(mode), sum(q_corrects[3:]) / sum(q_nums[3:]), epoch_idx)
-    writer.add_scalar('{} total accuracy'.format(mode), sum(q_correct.values()) / len(loader.dataset), epoch_idx)
+        epoch_loss / data_size,
+        epoch_time,
+        data_size / epoch_time,
+        q_correct.sum() / data_size))
+    print('====> {}: {} Data wait: {:.4f} / Stalled batches: {}/{}'.format(mode, epoch_idx, batches.wait, batches.stalls, len(batches)))
+    writer.add_scalar('{} loss'.format(mode), epoch_loss / data_size, epoch_idx)
+    writer.add_scalar('{} throughput'.format(mode), data_size / epoch_time, epoch_idx)
+    writer.add_scalar('{} data wait'.format(mode), batches.wait, epoch_idx)
+    writer.add_scalar('{} stalled batches'.format(mode), batches.stalls, epoch_idx)
+    profiler.log(writer, mode, epoch_idx, batches.wait)
+    if network.text_cache is not None and not is_train:
+        text_cache = network.text_cache
+        writer.add_scalar('Text cache hit rate', text_cache.hits / max(text_cache.hits + text_cache.misses, 1), epoch_idx)
+    writer.add_scalar('{} total accuracy'.format(mode), q_correct.sum() / data_size, epoch_idx)
+    # per color and question type breakdowns, for datasets labelling them (sortofclevr)
+    if args.c_size > 1:
+        q_acc = {}
+        for i in range(args.q_size):
+            q_acc['question {}'.format(str(i))] = q_correct[i] / max(q_num[i], 1)
+        writer.add_scalars('{} accuracy per question'.format(mode), q_acc, epoch_idx)
+        writer.add_scalar('{} non-rel accuracy'.format(mode), q_correct[:3].sum() / max(q_num[:3].sum(), 1), epoch_idx)
+        writer.add_scalar('{} rel accuracy'.format(mode), q_correct[3:].sum() / max(q_num[3:].sum(), 1), epoch_idx)
+        cell_acc = tally[:, :, 1] / tally.sum(2).clip(min=1)
+        rows = ['| color | ' + ' | '.join(loader.dataset.idx_to_question[i] for i in range(args.q_size)) + ' |',
+                '|---' * (args.q_size + 1) + '|']
+        for c in range(args.c_size):
+            rows.append('| {} | '.format(loader.dataset.idx_to_color[c]) + ' | '.join('{:.4f}'.format(a) for a in cell_acc[c]) + ' |')
+        writer.add_text('{} accuracy per color and question'.format(mode), '\n'.join(rows), epoch_idx)
 
 
 if __name__ == '__main__':
-    optimizer = optim.Adam([param for model in models.values() for param in list(model.parameters())], lr=args.lr)
-    writer = SummaryWriter(args.log)
+    optimizer = optim.Adam(network.parameters(), lr=args.lr)
+    writer = SummaryWriter(args.log) if args.rank == 0 else None
+    if args.autotune:
+        tuned = autotune.autotune(args, network, train_loader)
+        args.threads = tuned['threads']
+        args.loader_config = tuned['loader_config']
+        train_loader = dataloader.reload(train_loader, args.loader_config)
+        if not isinstance(test_loader.dataset, dataloader.IterableDataset):
+            test_loader = dataloader.reload(test_loader, args.loader_config)
+        with open(args.log + 'autotune.json', 'w') as file:
+            json.dump(tuned, file, indent=1)
+        writer.add_text('Autotune', json.dumps({key: tuned[key] for key in ['threads', 'loader_config', 'throughput', 'cores']}), 0)
+    # after autotune, which times copies of the network
+    profiler = profiling.StepProfiler(network, device, args.profile, args.profile_trace, args.log)
     for epoch_idx in range(args.start_epoch, args.start_epoch + args.epochs):
         epoch(epoch_idx, True)
-        epoch(epoch_idx, False)
-        for model_name, model in models.items():
-            torch.save(model.state_dict(), args.log + model_name)
-        print('Model saved in ', args.log)
-    writer.close()
+        with torch.no_grad():
+            epoch(epoch_idx, False)
+        if args.rank == 0:
+            for model_name, model in network.module_files().items():
+                torch.save(model.state_dict(), args.log + model_name)
+            print('Model saved in ', args.log)
+    profiler.close()
+    if args.rank == 0:
+        writer.close()
+    if args.distributed:
+        dist.destroy_process_group()
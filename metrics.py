@@ -0,0 +1,40 @@
+import torch
+import torch.distributed as dist
+
+
+class Metrics:
+    """Running loss and correct / total tallies per color x question type, kept on the device.
+
+    update only issues device ops; values reach the host when loss() or tally() are read, so
+    that reading them once per log interval or epoch is the only synchronization.
+    Questions without color and type (CLEVR, c_size 1 and q_size 1) are counted as color 0, type 0.
+    """
+    def __init__(self, c_size, q_size, device):
+        self.c_size = c_size
+        self.q_size = q_size
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        self.loss_sum = torch.zeros((), device=self.device)
+        self.counts = torch.zeros(self.c_size * self.q_size * 2, dtype=torch.long, device=self.device)
+
+    def update(self, loss, correct, question):
+        self.loss_sum += loss.detach().float()
+        if isinstance(question, torch.Tensor):
+            cell = question[:, 0] * self.q_size + question[:, 1]
+        else:
+            cell = torch.zeros_like(correct, dtype=torch.long)
+        self.counts += torch.bincount(cell * 2 + correct.long(), minlength=self.counts.numel())
+
+    def all_reduce(self):
+        """Sums the tallies of every process of the process group."""
+        dist.all_reduce(self.loss_sum)
+        dist.all_reduce(self.counts)
+
+    def loss(self):
+        return self.loss_sum.item()
+
+    def tally(self):
+        """(c_size, q_size, 2) array of wrong / correct counts."""
+        return self.counts.view(self.c_size, self.q_size, 2).cpu().numpy()
@@ -1,7 +1,9 @@
 import torch
 from torch import nn
-from torch.nn.utils.rnn import PackedSequence
+from torch.nn.utils.rnn import PackedSequence, pack_padded_sequence, pad_packed_sequence
+from collections import OrderedDict
 import numpy as np
+import utils
 
 
 class MLP(nn.Module):
@@ -63,7 +65,8 @@ class Text_encoder(nn.Module):
 
     def forward(self, x):
         embedded = self.embedding(x.data)
-        packed_embedded = PackedSequence(embedded, x.batch_sizes)
+        # the lstm returns h_n in batch order through unsorted_indices (packed with enforce_sorted=False)
+        packed_embedded = PackedSequence(embedded, x.batch_sizes, x.sorted_indices, x.unsorted_indices)
         output, (h_n, c_n) = self.lstm(packed_embedded)
         return h_n.squeeze(0)
 
@@ -186,3 +189,172 @@ class Film_Classifier(nn.Module):
         x = self.mlp(x)
         return x
 
+
+
+class Text_cache(object):
+    """LRU cache of text encoder outputs per question, for evaluation and serving.
+
+    Questions are keyed by their (color, question type) or by their tokens. Only the questions
+    missing from the cache are encoded, once per distinct question of the batch. The cache is
+    cleared whenever a parameter of the text encoder has been modified in place (optimizer steps,
+    load_state_dict), as seen from the parameter versions.
+    """
+    def __init__(self, text_encoder, size):
+        self.text_encoder = text_encoder
+        self.size = size
+        self.entries = OrderedDict()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, question):
+        version = tuple(parameter._version for parameter in self.text_encoder.parameters())
+        if version != self.version:
+            self.entries.clear()
+            self.version = version
+        if isinstance(question, PackedSequence):
+            padded, lengths = pad_packed_sequence(question, batch_first=True)
+            keys = [tuple(q[:l]) for q, l in zip(padded.tolist(), lengths.tolist())]
+        else:
+            keys = [tuple(q) for q in question.tolist()]
+        missing = dict()
+        for n, key in enumerate(keys):
+            if key not in self.entries and key not in missing:
+                missing[key] = n
+        self.misses += len(missing)
+        self.hits += len(keys) - len(missing)
+        if missing:
+            index = torch.tensor(list(missing.values()), device=question.data.device)
+            if isinstance(question, PackedSequence):
+                subset = pack_padded_sequence(padded.index_select(0, index), lengths[index.cpu()], batch_first=True, enforce_sorted=False)
+            else:
+                subset = question.index_select(0, index)
+            with torch.no_grad():
+                codes = self.text_encoder(subset)
+            for key, code in zip(missing, codes):
+                self.entries[key] = code
+        for key in keys:
+            self.entries.move_to_end(key)
+        codes = torch.stack([self.entries[key] for key in keys])
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return codes
+
+
+class Network(nn.Module):
+    """Text encoder and convolution shared by every architecture, composed with the head of a subclass
+    into a single forward(image, question) that can be handed to torch.compile.
+    After freeze_conv, forward takes the conv outputs (see dataloader.Clevr.use_features) in place of images."""
+    def __init__(self, text_encoder, conv):
+        super(Network, self).__init__()
+        self.text_encoder = text_encoder
+        self.conv = conv
+        self.precomputed = False
+        self.text_cache = None
+
+    def module_files(self):
+        return {name + '.pt': module for name, module in self.named_children()}
+
+    def cache_text(self, size):
+        """Reuse text encoder outputs across batches in eval mode, for up to size distinct questions."""
+        self.text_cache = Text_cache(self.text_encoder, size)
+
+    def freeze_conv(self):
+        self.conv.requires_grad_(False)
+        self.precomputed = True
+
+    def encode_image(self, image):
+        return self.conv(image * 2 - 1)
+
+    def forward(self, image, question, image_idx=None):
+        if self.text_cache is not None and not self.training:
+            code = self.text_cache(question)
+        else:
+            code = self.text_encoder(question)
+        objects = image if self.precomputed else self.encode_image(image)
+        if image_idx is not None:
+            objects = objects.index_select(0, image_idx)
+        return self.head(objects, code)
+
+
+class Baseline(Network):
+    def __init__(self, text_encoder, conv, g_theta, f_phi):
+        super(Baseline, self).__init__(text_encoder, conv)
+        self.g_theta = g_theta
+        self.f_phi = f_phi
+
+    def head(self, objects, code):
+        pairs = utils.baseline_encode(objects, code)
+        relations = self.g_theta(pairs)
+        relations = relations.sum(1)
+        return self.f_phi(relations)
+
+
+class RN(Network):
+    def __init__(self, text_encoder, conv, g_theta, f_phi, mode='dense', chunk_size=0, memory=0):
+        super(RN, self).__init__(text_encoder, conv)
+        self.g_theta = g_theta
+        self.f_phi = f_phi
+        self.mode = mode
+        self.chunk_size = chunk_size
+        self.memory = memory
+
+    def head(self, objects, code):
+        if self.mode == 'pairfree':
+            relations = utils.rn_pairfree(objects, code, self.g_theta, self.chunk_size, self.memory)
+        else:
+            pairs = utils.rn_encode(objects, code)
+            relations = self.g_theta(pairs)
+            relations = utils.lower_sum(relations)
+            relations = relations.sum(1)
+        return self.f_phi(relations)
+
+
+class SARN(Network):
+    def __init__(self, text_encoder, conv, g_theta, f_phi, h_psi, topk=0, side='object', grad='st'):
+        super(SARN, self).__init__(text_encoder, conv)
+        self.g_theta = g_theta
+        self.f_phi = f_phi
+        self.h_psi = h_psi
+        self.topk = topk
+        self.side = side
+        self.grad = grad
+
+    def head(self, objects, code):
+        coordinate_encoded, question_encoded = utils.sarn_encode(objects, code)
+        logits = self.h_psi(question_encoded)
+        if self.topk:
+            relations = utils.sarn_topk(coordinate_encoded, question_encoded, logits, self.g_theta,
+                                        self.topk, self.side, self.grad)
+        else:
+            pairs = utils.sarn_pair(coordinate_encoded, question_encoded, logits)
+            relations = self.g_theta(pairs)
+            relations = relations.sum(1)
+        return self.f_phi(relations)
+
+
+class SARN_att(Network):
+    def __init__(self, text_encoder, conv, g_theta, f_phi, h_psi, attn):
+        super(SARN_att, self).__init__(text_encoder, conv)
+        self.g_theta = g_theta
+        self.f_phi = f_phi
+        self.h_psi = h_psi
+        self.attn = attn
+
+    def head(self, objects, code):
+        coordinate_encoded, question_encoded = utils.sarn_encode(objects, code)
+        logits = self.h_psi(question_encoded)
+        selected = utils.sarn_select(coordinate_encoded, logits)
+        relations, att = self.attn(selected, coordinate_encoded, coordinate_encoded)
+        relations = self.g_theta(relations)
+        relations = relations.sum(1)
+        return self.f_phi(relations)
+
+
+class Film_network(Network):
+    def __init__(self, text_encoder, conv, film):
+        super(Film_network, self).__init__(text_encoder, conv)
+        self.film = film
+
+    def head(self, objects, code):
+        return self.film(objects, code)
@@ -0,0 +1,212 @@
+"""Per-component timing of training and test steps (--profile), with an optional torch.profiler trace."""
+import contextlib
+import time
+import weakref
+import torch
+from torch.profiler import profile, schedule, tensorboard_trace_handler, record_function, ProfilerActivity
+from torch.nn.utils.rnn import PackedSequence
+
+
+def tensors(value):
+    if isinstance(value, torch.Tensor):
+        return [value]
+    if isinstance(value, PackedSequence):
+        return [value.data]
+    if isinstance(value, (tuple, list)):
+        return [tensor for item in value for tensor in tensors(item)]
+    return []
+
+
+class StepProfiler(object):
+    """Time and peak memory per step of the sections of a step (forward, backward, optimizer), split
+    between the children of network (text_encoder, conv, h_psi, g_theta, attn, f_phi, film), the rest
+    of the network ('pairs': the pair builders of utils and the relation sums) and the loss.
+
+    Forward time is split at the forward hooks of the modules, backward time at hooks on the gradients
+    of their outputs (start of their backward) and of their inputs (end of it). The device is synchronized
+    at every split, so profiled steps are slower than plain ones.
+    Peak memory is the most memory allocated during a part above the memory allocated when it starts.
+    On cuda it is read from the allocator. On cpu, every step runs under torch.profiler with profile_memory,
+    the splits are marked in it with record_function, and the allocations and frees of the ops of the step
+    are replayed in order; the ops run slower under it, and the times include that overhead.
+    With trace [start, steps], steps start to start + steps - 1 of the run are recorded by torch.profiler
+    into trace_dir, for the TensorBoard profiler plugin. Does nothing when not enabled.
+    """
+    def __init__(self, network, device, enabled=True, trace=(0, 0), trace_dir=None):
+        self.device = device
+        self.enabled = enabled
+        self.cuda = device.type == 'cuda'
+        self.phase = None
+        self.label = None
+        self.trace = None
+        self.memory = None
+        self.run_steps = 0
+        self.trace_window = range(trace[0], trace[0] + trace[1])
+        self.trace_handler = tensorboard_trace_handler(trace_dir) if trace[1] else None
+        self.reset()
+        if not enabled:
+            return
+        self.watch(network, 'pairs', 'loss')
+        for name, module in network.named_children():
+            self.watch(module, name, 'pairs')
+        start, steps = trace
+        if steps and self.cuda:
+            self.trace = profile(
+                activities=[ProfilerActivity.CPU, ProfilerActivity.CUDA],
+                schedule=schedule(skip_first=max(start - 1, 0), wait=0, warmup=min(start, 1), active=steps, repeat=1),
+                on_trace_ready=self.trace_handler, record_shapes=True, profile_memory=True)
+            self.trace.start()
+
+    def reset(self):
+        self.started = dict()
+        self.steps = 0
+        self.times = dict()
+        self.peaks = dict()
+
+    def watch(self, module, name, outside):
+        def before(module, inputs):
+            self.switch(name)
+            self.on_grad(inputs, outside, start=False)
+
+        def after(module, inputs, output):
+            self.switch(outside)
+            self.on_grad(output, name, start=True)
+        module.register_forward_pre_hook(before)
+        module.register_forward_hook(after)
+
+    def on_grad(self, value, label, start):
+        """Switches to label when the gradient of value is computed in backward. A tensor that is the output
+        of a module keeps the switch to the backward of that module (start), the first one registered: it
+        also ends the backward of the modules taking it as input, and of the network returning it."""
+        if not torch.is_grad_enabled():
+            return
+        for tensor in tensors(value):
+            started = self.started.get(id(tensor))
+            if not tensor.requires_grad or (started is not None and started() is tensor):
+                continue
+            if start:
+                self.started[id(tensor)] = weakref.ref(tensor)
+            tensor.register_hook(lambda grad: self.switch(label))
+
+    def clock(self):
+        if self.cuda:
+            torch.cuda.synchronize(self.device)
+        return time.perf_counter()
+
+    def switch(self, label):
+        """Charges the time since the last switch to the current part of the section, and starts label."""
+        if self.phase is None:
+            return
+        now = self.clock()
+        key = (self.phase, self.label)
+        self.times[key] = self.times.get(key, 0) + now - self.last
+        if self.cuda:
+            peak = torch.cuda.max_memory_allocated(self.device) - self.allocated
+            self.peaks[key] = max(self.peaks.get(key, 0), peak)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            self.allocated = torch.cuda.memory_allocated(self.device)
+        self.label = label
+        self.mark()
+        self.last = self.clock()
+
+    def mark(self):
+        """Records the start of the current part in the memory profile of the step (cpu)."""
+        if self.memory is not None:
+            with record_function('StepProfiler/{}/{}'.format(self.phase, self.label)):
+                pass
+
+    def memory_peaks(self):
+        """Adds the peaks of the parts of the step from its memory profile: the allocations (self memory of
+        the ops) and frees of the thread of the step, summed in order from the mark of every part."""
+        events = sorted(self.memory.events(), key=lambda event: event.time_range.start)
+        marks = [event for event in events if event.name.startswith('StepProfiler/')]
+        if not marks:
+            return
+        thread = marks[0].thread
+        key = None
+        allocated = base = 0
+        for event in events:
+            if event.thread != thread:
+                continue
+            if event.name.startswith('StepProfiler/'):
+                phase, label = event.name.split('/')[1:]
+                key = None if label == 'None' else (phase, label)
+                base = allocated
+                if key is not None:
+                    self.peaks.setdefault(key, 0)
+                continue
+            allocated += event.self_cpu_memory_usage
+            if key is not None:
+                self.peaks[key] = max(self.peaks[key], allocated - base)
+
+    @contextlib.contextmanager
+    def section(self, phase, label=None):
+        """Profiles the block as phase, its time outside of the watched modules charged to label (phase by default)."""
+        if not self.enabled:
+            yield
+            return
+        self.phase = phase
+        self.label = label or phase
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+            self.allocated = torch.cuda.memory_allocated(self.device)
+        elif self.memory is None:
+            # one memory profile per step, from its first section
+            self.memory = profile(activities=[ProfilerActivity.CPU], profile_memory=True,
+                                  record_shapes=self.run_steps in self.trace_window)
+            self.memory.start()
+        self.mark()
+        self.last = self.clock()
+        try:
+            yield
+        finally:
+            self.switch(None)
+            self.phase = None
+
+    def step(self):
+        if not self.enabled:
+            return
+        self.started.clear()
+        self.steps += 1
+        if self.trace is not None:
+            self.trace.step()
+        if self.memory is not None:
+            self.memory.stop()
+            self.memory_peaks()
+            if self.run_steps in self.trace_window:
+                self.trace_handler(self.memory)
+            self.memory = None
+        self.run_steps += 1
+
+    def log(self, writer, mode, epoch_idx, data_wait):
+        """Prints and writes the ms and peak MB per step of every part since reset, with data_wait seconds
+        of waiting for batches over the same steps."""
+        if not self.enabled:
+            return
+        steps = max(self.steps, 1)
+        times = dict()
+        peaks = dict()
+        for (phase, label), seconds in self.times.items():
+            times.setdefault(phase, dict())[label] = seconds / steps * 1e3
+            peaks.setdefault(phase, dict())[label] = self.peaks.get((phase, label), 0) / 2 ** 20
+        text = ['data wait {:.2f}'.format(data_wait / steps * 1e3)]
+        writer.add_scalar('{} data wait ms per step'.format(mode), data_wait / steps * 1e3, epoch_idx)
+        for phase, parts in times.items():
+            writer.add_scalars('{} {} ms per step'.format(mode, phase), parts, epoch_idx)
+            text.append('{} {:.2f}'.format(phase, sum(parts.values())))
+            if list(parts) != [phase]:
+                text[-1] += ' ({})'.format(', '.join(
+                    '{} {:.2f}'.format(label, ms) for label, ms in sorted(parts.items(), key=lambda part: -part[1])))
+        print('====> {}: {} Profile, ms per step: {}'.format(mode, epoch_idx, ' / '.join(text)))
+        text = []
+        for phase, parts in peaks.items():
+            writer.add_scalars('{} {} peak MB'.format(mode, phase), parts, epoch_idx)
+            text.append('{} ({})'.format(phase, ', '.join(
+                '{} {:.2f}'.format(label, mb) for label, mb in sorted(parts.items(), key=lambda part: -part[1]))))
+        print('====> {}: {} Profile, peak MB: {}'.format(mode, epoch_idx, ' / '.join(text)))
+
+    def close(self):
+        if self.trace is not None:
+            self.trace.stop()
+        if self.memory is not None:
+            self.memory.stop()
@@ -0,0 +1,278 @@
+"""Batched inference server for a trained model, with a load generator.
+
+python serve.py serve --model rn --load-model <time stamp + config of a run> --port 8000 --max-batch 64 --max-latency 5
+python serve.py load --model rn --port 8000 --requests 2000 --concurrency 32 --questions-per-image 4
+
+POST /predict {"image": base64 of the uint8 input_h x input_w x 3 image, "question": [color, question type] or tokens}
+    -> {"answer": index, "text": answer}
+    400 for malformed requests and questions out of the vocabulary, 500 if the batch of the request failed
+GET /stats -> {"requests", "batches", "batch size", "p50 ms", "p99 ms", "qps"}
+Model and data options are read as in main.py; the test set gives the vocabulary and the load generator queries.
+"""
+import argparse
+import base64
+import collections
+import http.client
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import torch
+from torch.nn.utils.rnn import pack_sequence
+from build_model import build_model
+from configuration import get_config
+import dataloader
+
+
+class Request(object):
+    def __init__(self, image, question):
+        self.image = image
+        self.question = question
+        self.arrival = time.time()
+        self.done = threading.Event()
+        self.answer = None
+        self.error = None
+
+
+class Batcher(object):
+    """Runs the network on batches of the queued requests, of up to max_batch requests. A batch waits for
+    requests until max_latency seconds after the arrival of its first one, and then takes the requests
+    already queued. Requests with identical images share one conv pass."""
+    def __init__(self, network, args, max_batch, max_latency):
+        self.network = network
+        self.args = args
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.image_shape = (args.input_h, args.input_w, args.channel_size)
+        self.queue = queue.Queue()
+        self.latencies = collections.deque(maxlen=100000)
+        self.requests = 0
+        self.batches = 0
+        self.first_arrival = None
+        self.last_answer = None
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, image, question):
+        request = Request(image, question)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise RuntimeError(request.error)
+        return request.answer
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = batch[0].arrival + self.max_latency
+            while len(batch) < self.max_batch:
+                # past the deadline, requests already waiting are still taken
+                try:
+                    batch.append(self.queue.get(timeout=max(deadline - time.time(), 0)))
+                except queue.Empty:
+                    break
+            try:
+                self.predict(batch)
+            except Exception as error:
+                # fail the requests of the batch and keep serving
+                traceback.print_exc()
+                for request in batch:
+                    request.error = '{}: {}'.format(type(error).__name__, error)
+                    request.done.set()
+
+    def predict(self, batch):
+        device = self.args.device
+        images = dict()
+        image_idx = [images.setdefault(request.image, len(images)) for request in batch]
+        image = np.stack([np.frombuffer(i, dtype=np.uint8).reshape(self.image_shape) for i in images])
+        dtype = torch.bfloat16 if self.args.precision == 'bf16' else torch.float
+        image = torch.from_numpy(image.transpose(0, 3, 1, 2)).to(device, dtype) / 255
+        if self.args.dataset == 'clevr':
+            question = pack_sequence([torch.tensor(request.question) for request in batch], enforce_sorted=False).to(device)
+        else:
+            question = torch.tensor([request.question for request in batch], device=device)
+        with torch.no_grad(), torch.autocast(device.type, dtype=torch.bfloat16, enabled=self.args.precision == 'bf16'):
+            output = self.network(image, question, torch.tensor(image_idx, device=device))
+        answers = output.argmax(1).tolist()
+        now = time.time()
+        if self.first_arrival is None:
+            self.first_arrival = batch[0].arrival
+        self.last_answer = now
+        self.requests += len(batch)
+        self.batches += 1
+        for request, answer in zip(batch, answers):
+            request.answer = answer
+            self.latencies.append(now - request.arrival)
+            request.done.set()
+
+    def stats(self):
+        latencies = np.array(self.latencies) * 1e3 if self.latencies else np.zeros(1)
+        elapsed = self.last_answer - self.first_arrival if self.first_arrival else 0
+        return {'requests': self.requests,
+                'batches': self.batches,
+                'batch size': self.requests / max(self.batches, 1),
+                'p50 ms': float(np.percentile(latencies, 50)),
+                'p99 ms': float(np.percentile(latencies, 99)),
+                'qps': self.requests / elapsed if elapsed else 0}
+
+
+class Server(ThreadingHTTPServer):
+    request_queue_size = 128
+    daemon_threads = True
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    batcher = None
+    answer_text = None
+    question_sizes = None
+
+    def do_POST(self):
+        if self.path != '/predict':
+            return self.reply({'error': 'unknown path'}, 404)
+        try:
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            image = base64.b64decode(body['image'])
+            question = body['question']
+        except (ValueError, KeyError, TypeError) as error:
+            return self.reply({'error': 'bad request: {}'.format(error)}, 400)
+        if len(image) != np.prod(self.batcher.image_shape):
+            return self.reply({'error': 'image must be {} x {} x {} uint8'.format(*self.batcher.image_shape)}, 400)
+        error = self.question_error(question)
+        if error:
+            return self.reply({'error': error}, 400)
+        try:
+            answer = self.batcher.submit(image, question)
+        except RuntimeError as error:
+            return self.reply({'error': str(error)}, 500)
+        self.reply({'answer': answer, 'text': self.answer_text[answer]})
+
+    def question_error(self, question):
+        """Why question is not a question of the dataset, None if it is."""
+        if not isinstance(question, list) or not all(isinstance(q, int) and not isinstance(q, bool) for q in question):
+            return 'question must be a list of integers'
+        if len(self.question_sizes) == 1:
+            if not question or not all(0 <= q < self.question_sizes[0] for q in question):
+                return 'question must be 1 or more tokens in [0, {})'.format(self.question_sizes[0])
+        elif len(question) != 2 or not all(0 <= q < size for q, size in zip(question, self.question_sizes)):
+            return 'question must be [color in [0, {}), question type in [0, {})]'.format(*self.question_sizes)
+
+    def do_GET(self):
+        if self.path != '/stats':
+            return self.reply({'error': 'unknown path'}, 404)
+        self.reply(self.batcher.stats())
+
+    def reply(self, content, status=200):
+        content = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def load_dataset(args):
+    dataset = dataloader.test_loader(args.dataset, args.data_directory, args.batch_size, args.data_config,
+                                     stream_config=args.stream_config).dataset
+    args.label_size = dataset.a_size
+    args.q_size = dataset.q_size
+    args.c_size = getattr(dataset, 'c_size', 1)
+    return dataset
+
+
+def serve(args, options):
+    dataset = load_dataset(args)
+    network = build_model(args)
+    if args.load_model != '000000000000':
+        for model_name, model in network.module_files().items():
+            model.load_state_dict(torch.load(os.path.join(args.log_directory + args.project, args.load_model, model_name)))
+        print('Model {} loaded.'.format(args.load_model))
+    network.eval()
+    if args.text_cache:
+        network.cache_text(args.text_cache)
+    Handler.batcher = Batcher(network, args, options.max_batch, options.max_latency / 1e3)
+    Handler.answer_text = dataset.answer_idx_to_word if args.dataset == 'clevr' else dataset.idx_to_answer
+    # vocabulary of CLEVR tokens, colors and question types of Sort-of-CLEVR
+    Handler.question_sizes = [args.q_size] if args.dataset == 'clevr' else [args.c_size, args.q_size]
+    server = Server((options.host, options.port), Handler)
+    print('Serving on {}:{}'.format(options.host, options.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(Handler.batcher.stats()))
+
+
+def load(args, options):
+    """Sends test set queries from concurrency connections, questions_per_image consecutive queries per image,
+    and prints the client side latency and throughput next to the server stats."""
+    dataset = load_dataset(args)
+    if args.dataset == 'clevr':
+        order = np.argsort(dataset.image_idx, kind='stable')
+    else:
+        order = np.arange(len(dataset))
+    rng = np.random.default_rng(args.seed)
+    starts = rng.integers(0, len(dataset) - options.questions_per_image + 1, -(-options.requests // options.questions_per_image))
+    indices = np.concatenate([order[start:start + options.questions_per_image] for start in starts])[:options.requests]
+    queries = queue.Queue()
+    for idx in indices:
+        image, question, answer = dataset[int(idx)]
+        image = (image.float() * 255).round().byte().permute(1, 2, 0).numpy().tobytes()
+        queries.put(json.dumps({'image': base64.b64encode(image).decode(), 'question': question.tolist()}))
+    latencies = []
+    errors = []
+
+    def client():
+        connection = http.client.HTTPConnection(options.host, options.port)
+        while True:
+            try:
+                query = queries.get_nowait()
+            except queue.Empty:
+                break
+            start_time = time.time()
+            try:
+                connection.request('POST', '/predict', query, {'Content-Type': 'application/json'})
+                connection.getresponse().read()
+            except (http.client.HTTPException, OSError) as error:
+                errors.append(error)
+                connection.close()
+                connection = http.client.HTTPConnection(options.host, options.port)
+                continue
+            latencies.append(time.time() - start_time)
+        connection.close()
+
+    start_time = time.time()
+    clients = [threading.Thread(target=client) for _ in range(options.concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.time() - start_time
+    latencies = np.array(latencies) * 1e3
+    print('client: {} requests / {} errors / p50 {:.2f} ms / p99 {:.2f} ms / {:.1f} qps'.format(
+        len(latencies), len(errors), np.percentile(latencies, 50), np.percentile(latencies, 99), len(latencies) / elapsed))
+    connection = http.client.HTTPConnection(options.host, options.port)
+    connection.request('GET', '/stats')
+    print('server:', connection.getresponse().read().decode())
+
+
+commands = {'serve': serve, 'load': load}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='parser')
+    parser.add_argument('command', type=str, choices=list(commands.keys()))
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch', type=int, default=64, help='requests per batch')
+    parser.add_argument('--max-latency', type=float, default=5, help='ms a batch waits for requests after its first one')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--questions-per-image', type=int, default=4)
+    options, unparsed = parser.parse_known_args()
+    commands[options.command](get_config(), options)
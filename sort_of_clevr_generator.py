@@ -1,9 +1,7 @@
-import cv2
 import os
 import numpy as np
+from multiprocessing import Pool
 import random
-import pickle
-from skimage.draw import circle
 from skimage.draw import rectangle
 from skimage.draw import polygon
 from pathlib import Path
@@ -17,6 +15,10 @@ if __name__ == '__main__':
 	parser.add_argument('--image-size', type=int, default=75)
 	parser.add_argument('--size', type=int, default=5)
 	parser.add_argument('--closest', type=int, default=3)
+	parser.add_argument('--data-directory', type=str, default=home + '/data/')
+	parser.add_argument('--seed', type=int, default=1)
+	parser.add_argument('--num-workers', type=int, default=os.cpu_count())
+	parser.add_argument('--shard-size', type=int, default=1000)
 	args = parser.parse_args()
 	config = '_'.join(map(str, [args.train_size, args.test_size, args.image_size, args.size, args.closest]))
 	train_size = args.train_size
@@ -24,6 +26,10 @@ if __name__ == '__main__':
 	img_size = args.image_size
 	size = args.size
 	closest = args.closest
+	data_directory = args.data_directory
+	seed = args.seed
+	num_workers = args.num_workers
+	shard_size = args.shard_size
 
 slack = 5
 num_shape = 2
@@ -159,6 +165,8 @@ def center_generate(objects):
 
 
 def build_dataset():
+    # removed from skimage 0.19, only needed by the legacy generators
+    from skimage.draw import circle
     objects = []
     img = np.ones((img_size, img_size, 3)) * 255
     for color_id, color in enumerate(colors):
@@ -293,6 +301,8 @@ def build_dataset():
     return dataset
 
 def build_dataset_all_question():
+    # removed from skimage 0.19, only needed by the legacy generators
+    from skimage.draw import circle
     objects = []
     img = np.ones((img_size, img_size, 3)) * 255
     for color_id, color in enumerate(colors):
@@ -453,35 +463,147 @@ def build_dataset_all_question():
     return dataset
 
 
+def shape_templates(size):
+    """Boolean (2 * size + 1)^2 stamps of a rectangle and a circle, pixel-identical to
+    skimage's rectangle(center - size, center + size) and circle(*center, size + 1)."""
+    offset = np.arange(-size, size + 1)
+    rec = np.ones((2 * size + 1, 2 * size + 1), dtype=bool)
+    cir = offset[:, None] ** 2 + offset[None, :] ** 2 < (size + 1) ** 2
+    return np.stack([rec, cir])
+
+
+def generate_centers(rng, img_size, size, closest, block=16):
+    """center_generate for all objects of a scene, testing a block of candidates at once."""
+    centers = np.zeros((len(colors), 2), dtype=np.int64)
+    for n in range(len(colors)):
+        while True:
+            candidates = rng.integers(0 + size + slack, img_size - size - slack, (block, 2))
+            dist = ((candidates[:, None] - centers[None, :n]) ** 2).sum(2)
+            passed = (dist >= closest * (size * 2) ** 2).all(1)
+            if passed.any():
+                centers[n] = candidates[passed.argmax()]
+                break
+    return centers
+
+
+def render_scenes(rng, scene_size, img_size, size, closest):
+    """Draws scene_size scenes. Returns uint8 images (N x H x W x 3), centers (N x 6 x 2) and shapes (N x 6)."""
+    templates = shape_templates(size)
+    images = np.full((scene_size, img_size, img_size, 3), 255, dtype=np.uint8)
+    centers = np.stack([generate_centers(rng, img_size, size, closest) for _ in range(scene_size)])
+    shapes = rng.integers(num_shape, size=(scene_size, len(colors)))
+    for n in range(scene_size):
+        for color_id, color in enumerate(colors):
+            r, c = centers[n, color_id]
+            images[n, r - size:r + size + 1, c - size:c + size + 1][templates[shapes[n, color_id]]] = color
+    return images, centers, shapes
+
+
+def scene_questions():
+    """(color, question type) of the 48 questions in the order of build_dataset_all_question."""
+    norel = [(color, subtype) for color in color_dict.keys() for subtype in [0, 1, 2]]
+    rel = [(color, subtype + 3) for color in color_dict.keys() for subtype in range(num_rel_qst)]
+    return np.array(norel + rel, dtype=np.int8)
+
+
+def scene_answers(centers, shapes, img_size):
+    """Answers of all 48 questions of every scene from the pairwise distance matrix (N x 48)."""
+    dist = ((centers[:, :, None] - centers[:, None]) ** 2).sum(3)
+    closest = (dist + np.eye(len(colors), dtype=dist.dtype) * (img_size ** 2) * 2).argmin(2)
+    furthest = dist.argmax(2)
+    count = (shapes[:, :, None] == shapes[:, None]).sum(2) - 1
+    shape_answer = shapes + 2
+    norel = np.stack([shape_answer,
+                      (centers[:, :, 0] >= img_size / 2).astype(np.int64),
+                      (centers[:, :, 1] >= img_size / 2).astype(np.int64)], 2)
+    rel = np.stack([closest + answer_size_before_color,
+                    furthest + answer_size_before_color,
+                    count + answer_size_before_count,
+                    np.take_along_axis(shape_answer, closest, 1),
+                    np.take_along_axis(shape_answer, furthest, 1)], 2)
+    return np.concatenate([norel.reshape(len(shapes), -1), rel.reshape(len(shapes), -1)], 1).astype(np.int8)
+
+
+def build_scenes(rng, scene_size, img_size, size, closest):
+    images, centers, shapes = render_scenes(rng, scene_size, img_size, size, closest)
+    return images, scene_answers(centers, shapes, img_size)
+
+
+def column_path(dirs, mode, column):
+    return os.path.join(dirs, 'sort-of-clevr-{}-{}.npy'.format(mode, column))
+
+
+def write_shard(shard):
+    """Pool worker: renders one shard and writes it into the preallocated column files."""
+    dirs, mode, entropy, start, stop, img_size, size, closest = shard
+    rng = np.random.default_rng(entropy)
+    images, answers = build_scenes(rng, stop - start, img_size, size, closest)
+    images_map = np.load(column_path(dirs, mode, 'images') + '.tmp', mmap_mode='r+')
+    answers_map = np.load(column_path(dirs, mode, 'answers') + '.tmp', mmap_mode='r+')
+    images_map[start:stop] = images
+    answers_map[start:stop] = answers
+    images_map.flush()
+    answers_map.flush()
+    return stop - start
+
+
+def generate_columns(dirs, mode, scene_size, img_size, size, closest, seed=1, shard_size=1000, num_workers=None):
+    """Writes scene_size scenes of one split as columns, shard by shard on a process pool.
+    Shard k is seeded with (seed, split, k), so the output does not depend on num_workers.
+    The columns are written to .tmp files, moved to their names once every shard is written, the images last
+    (their file marks a generated split)."""
+    np.lib.format.open_memmap(column_path(dirs, mode, 'images') + '.tmp', mode='w+',
+                              dtype=np.uint8, shape=(scene_size, img_size, img_size, 3)).flush()
+    np.lib.format.open_memmap(column_path(dirs, mode, 'answers') + '.tmp', mode='w+',
+                              dtype=np.int8, shape=(scene_size, 48)).flush()
+    with open(column_path(dirs, mode, 'questions') + '.tmp', 'wb') as file:
+        np.save(file, np.broadcast_to(scene_questions(), (scene_size, 48, 2)))
+    split = ['train', 'val'].index(mode)
+    shards = [(dirs, mode, (seed, split, k), start, min(start + shard_size, scene_size), img_size, size, closest)
+              for k, start in enumerate(range(0, scene_size, shard_size))]
+    done = 0
+    with Pool(num_workers) as pool:
+        for n in pool.imap_unordered(write_shard, shards):
+            done += n
+            print('{} scenes: {}/{}'.format(mode, done, scene_size))
+    for column in ['questions', 'answers', 'images']:
+        os.replace(column_path(dirs, mode, column) + '.tmp', column_path(dirs, mode, column))
+
+
+def to_columns(datasets):
+	"""Converts (img, relations, norelations) tuples into uint8 images (N x H x W x 3),
+	int8 (color, question type) pairs (N x 48 x 2) and int8 answers (N x 48)."""
+	images = np.stack([img for img, rel, norel in datasets]).astype(np.uint8)
+	questions = np.zeros((len(datasets), 48, 2), dtype=np.int8)
+	answers = np.zeros((len(datasets), 48), dtype=np.int8)
+	for n, (img, rel, norel) in enumerate(datasets):
+		for index, (q, a) in enumerate(zip(norel[0] + rel[0], norel[1] + rel[1])):
+			q = np.where(q)[0]
+			questions[n, index, 0] = q[0]
+			questions[n, index, 1] = q[2] - 8 if index < 18 else q[2] - 5
+			answers[n, index] = a
+	return images, questions, answers
+
+
 def generate_data(data_option=None):
 	if data_option:
-		dirs = home + '/data/sortofclevr3/{}'.format(data_option)
+		dirs = data_directory + 'sortofclevr/{}'.format(data_option)
 	else:
-		dirs = home + '/data/sortofclevr3'
+		dirs = data_directory + 'sortofclevr'
 
 	try:
 		os.makedirs(dirs)
 	except:
 		print('directory {} already exists'.format(dirs))
 
-	filename = os.path.join(dirs, 'sort-of-clevr3-train.pickle')
+	filename = os.path.join(dirs, 'sort-of-clevr-train-images.npy')
 
 	if not os.path.exists(filename):
 
 		print('building test datasets...')
-		test_datasets = [build_dataset_all_question() for _ in range(test_size)]
+		generate_columns(dirs, 'val', test_size, img_size, size, closest, seed, shard_size, num_workers)
 		print('building train datasets...')
-		train_datasets = [build_dataset_all_question() for _ in range(train_size)]
-
-		# img_count = 0
-		# cv2.imwrite(os.path.join(dirs,'{}.png'.format(img_count)), cv2.resize(train_datasets[0][0]*255, (512,512)))
-
-		print('saving datasets...')
-
-		with  open(os.path.join(dirs, 'sort-of-clevr3-train.pickle'), 'wb') as f:
-			pickle.dump(train_datasets, f)
-		with  open(os.path.join(dirs, 'sort-of-clevr3-val.pickle'), 'wb') as f:
-			pickle.dump(test_datasets, f)
+		generate_columns(dirs, 'train', train_size, img_size, size, closest, seed, shard_size, num_workers)
 		print('datasets saved at {}'.format(dirs))
 
 if __name__ == '__main__':
@@ -1,63 +1,168 @@
 import torch
 import torch.nn.functional as F
+from torch import nn
+from torch.utils.checkpoint import checkpoint
+
+grid_cache = dict()
+
+
+def coordinates(h, w, device, dtype, style):
+    """(h, w, 2) grid of the x (along h) and y (along w) coordinates, built once per (h, w, device, dtype, style).
+    style 'center' spans -h/2 to h/2 as in the baseline and sarn encoders, 'unit' spans -1 to 1 as in rn."""
+    key = (h, w, device, dtype, style)
+    if key not in grid_cache:
+        if style == 'unit':
+            x_coordinate = torch.linspace(-1, 1, h, device=device, dtype=dtype)
+            y_coordinate = torch.linspace(-1, 1, w, device=device, dtype=dtype)
+        else:
+            x_coordinate = torch.linspace(-h/2, h/2, h, device=device, dtype=dtype)
+            y_coordinate = torch.linspace(-w/2, w/2, w, device=device, dtype=dtype)
+        grid_cache[key] = torch.stack([x_coordinate.view(h, 1).expand(h, w), y_coordinate.view(1, w).expand(h, w)], 2)
+    return grid_cache[key]
+
+
+def tril_mask(h, w, device, dtype):
+    key = (h, w, device, dtype, 'tril')
+    if key not in grid_cache:
+        grid_cache[key] = torch.ones([h, w], device=device, dtype=dtype).tril().unsqueeze(0).unsqueeze(3)
+    return grid_cache[key]
+
+
+def broadcast_cat(tensors):
+    """torch.cat along the last dimension of tensors broadcast against each other in the others.
+    Each input is written once into a single output allocation, without expanded copies."""
+    shape = torch.broadcast_shapes(*[tensor.shape[:-1] for tensor in tensors])
+    output = tensors[0].new_empty(shape + (sum(tensor.size(-1) for tensor in tensors),))
+    start = 0
+    for tensor in tensors:
+        output[..., start:start + tensor.size(-1)] = tensor
+        start += tensor.size(-1)
+    return output
+
 
 def baseline_encode(images, questions):
-    device = images.get_device()
     n, c, h, w = images.size()
     o = h * w
     hd = questions.size(1)
-    x_coordinate = torch.linspace(-h/2, h/2, h).view(1, 1, h, 1).expand(n, 1, h, w).to(device)
-    y_coordinate = torch.linspace(-w/2, w/2, w).view(1, 1, 1, w).expand(n, 1, h, w).to(device)
-    questions = questions.unsqueeze(2).unsqueeze(3).expand(n, hd, h, w)
-    images = torch.cat([images, x_coordinate, y_coordinate, questions], 1).view(n, -1, o).transpose(1, 2)
+    coordinate = coordinates(h, w, images.device, images.dtype, 'center')
+    images = broadcast_cat([images.permute(0, 2, 3, 1), coordinate, questions.view(n, 1, 1, hd)]).view(n, o, -1)
     return images
 
 
 def rn_encode(images, questions):
-    device = images.get_device()
     n, c, h, w = images.size()
     o = h * w
     hd = questions.size(1)
-    x_coordinate = torch.linspace(-1, 1, h).view(1, h, 1, 1).expand(n, h, w, 1).contiguous().view(n, o, 1).to(device)
-    y_coordinate = torch.linspace(-1, 1, w).view(1, 1, w, 1).expand(n, h, w, 1).contiguous().view(n, o, 1).to(device)
-    images = images.view(n, c, o).transpose(1, 2)
-    images = torch.cat([images, x_coordinate, y_coordinate], 2)
-    images1 = images.unsqueeze(1).expand(n, o, o, c + 2).contiguous()
-    images2 = images.unsqueeze(2).expand(n, o, o, c + 2).contiguous()
-    questions = questions.unsqueeze(1).unsqueeze(2).expand(n, o, o, hd)
-    # pairs = torch.cat([images1, images2, questions], 3).view(n, o**2, -1)
-    pairs = torch.cat([images1, images2, questions], 3)
+    coordinate = coordinates(h, w, images.device, images.dtype, 'unit')
+    images = broadcast_cat([images.permute(0, 2, 3, 1), coordinate]).view(n, o, c + 2)
+    # pairs[:, i, j] = [images[:, j], images[:, i], questions]
+    pairs = broadcast_cat([images.unsqueeze(1), images.unsqueeze(2), questions.view(n, 1, 1, hd)])
     return pairs
 
 
 def lower_sum(relations):
-    device = relations.get_device()
     n, h, w, l = relations.size()
-    mask = torch.ones([h, w]).tril().unsqueeze(0).unsqueeze(3).to(device)
-    relations = relations * mask
+    relations = relations * tril_mask(h, w, relations.device, relations.dtype)
     return relations.sum(2)
 
 
+def rn_chunk_size(n, g_theta, memory, element_size=4):
+    """Pairs per chunk such that the g_theta activations of a chunk of n samples fit in memory MB."""
+    width = sum(layer.out_features for layer in g_theta.net if isinstance(layer, nn.Linear))
+    return max(1, int(memory * 2 ** 20 // (n * width * element_size)))
+
+
+def rn_block(left, right, i, j, rest):
+    return rest(left[:, j] + right[:, i]).sum(1)
+
+
+def rn_pairfree(objects, code, g_theta, chunk_size=0, memory=0):
+    """g_theta summed over the pairs kept by lower_sum, without building the pair tensor of rn_encode.
+
+    The first layer of g_theta sees [object j, object i, question] for pair (i, j), so it is split into
+    per object projections that are added by broadcasting, only for the pairs with j <= i.
+    chunk_size pairs are evaluated at a time (0 for all at once). With memory (MB) set, the chunk
+    size is chosen from that budget and chunks are checkpointed, so that backward recomputes
+    their activations instead of keeping them.
+    """
+    device = objects.device
+    n, c, h, w = objects.size()
+    o = h * w
+    coordinate = coordinates(h, w, device, objects.dtype, 'unit')
+    images = broadcast_cat([objects.permute(0, 2, 3, 1), coordinate]).view(n, o, c + 2)
+    first, rest = g_theta.net[0], g_theta.net[1:]
+    d = c + 2
+    left = images.matmul(first.weight[:, :d].t())
+    right = images.matmul(first.weight[:, d:2 * d].t()) + (code.matmul(first.weight[:, 2 * d:].t()) + first.bias).unsqueeze(1)
+    row, col = torch.tril_indices(o, o, device=device)
+    if memory:
+        chunk_size = rn_chunk_size(n, g_theta, memory, objects.element_size())
+    chunk_size = chunk_size or row.size(0)
+    relations = 0
+    for start in range(0, row.size(0), chunk_size):
+        i, j = row[start:start + chunk_size], col[start:start + chunk_size]
+        if memory and torch.is_grad_enabled():
+            relations = relations + checkpoint(rn_block, left, right, i, j, rest, use_reentrant=False)
+        else:
+            relations = relations + rn_block(left, right, i, j, rest)
+    return relations
+
+
 def sarn_encode(objects, code):
-    device = objects.get_device()
     n, c, h, w = objects.size()
     o = h * w
     hd = code.size(1)
-    x_coordinate = torch.linspace(-h/2, h/2, h).view(1, 1, h, 1).expand(n, 1, h, w).to(device)
-    y_coordinate = torch.linspace(-w/2, w/2, w).view(1, 1, 1, w).expand(n, 1, h, w).to(device)
-    coordinate_encoded = torch.cat([objects, x_coordinate, y_coordinate], 1)
-    question = code.view(n, hd, 1, 1).expand(n, hd, h, w)
-    question_encoded = torch.cat([coordinate_encoded, question], 1).view(n, -1, o).transpose(1, 2)
-    return coordinate_encoded.view(n, -1, o).transpose(1, 2), question_encoded
+    coordinate = coordinates(h, w, objects.device, objects.dtype, 'center')
+    coordinate_encoded = broadcast_cat([objects.permute(0, 2, 3, 1), coordinate]).view(n, o, c + 2)
+    question_encoded = broadcast_cat([coordinate_encoded, code.view(n, 1, hd)])
+    return coordinate_encoded, question_encoded
 
 
 def sarn_pair(coordinate_encoded, question_encoded, logits):
     selection = F.softmax(logits.squeeze(2), dim=1)
-    selected = torch.bmm(selection.unsqueeze(1), coordinate_encoded).expand_as(coordinate_encoded)
-    pairs = torch.cat([question_encoded, selected], 2)
+    selected = torch.bmm(selection.unsqueeze(1), coordinate_encoded)
+    pairs = broadcast_cat([question_encoded, selected])
     return pairs
 
 
+def sarn_topk(coordinate_encoded, question_encoded, logits, g_theta, k, side='object', grad='st'):
+    """SARN relations keeping only the k objects of highest h_psi logit, so that g_theta runs on k or k x k
+    pairs instead of o. k above the number of objects o keeps them all.
+
+    The top k question encoded objects are the g_theta rows on every side.
+    side='object' pairs them with the dense selection over all objects.
+    side='pair' pairs them with a selection over the top k objects only.
+    side='both' pairs each of them with each of the top k objects, weighted by that selection.
+    Kept rows are weighted by 1 + p - p.detach(), with forward value 1, so that h_psi also learns from
+    the row selection: p is the softmax over all objects (grad='st', a straight-through estimator) or
+    k times the softmax over the kept logits (grad='soft'). With k = o, 'object' and 'pair' give the
+    dense SARN outputs.
+    """
+    logits = logits.squeeze(2)
+    n, o, d = coordinate_encoded.size()
+    k = min(k, o)
+    top_logits, top_idx = logits.topk(k, 1)
+    rows = question_encoded.gather(1, top_idx.unsqueeze(2).expand(n, k, question_encoded.size(2)))
+    if side == 'object':
+        selection = F.softmax(logits, dim=1)
+        selected = torch.bmm(selection.unsqueeze(1), coordinate_encoded)
+    else:
+        selection = F.softmax(top_logits, dim=1)
+        candidates = coordinate_encoded.gather(1, top_idx.unsqueeze(2).expand(n, k, d))
+        selected = torch.bmm(selection.unsqueeze(1), candidates)
+    if grad == 'st':
+        p = F.softmax(logits, dim=1).gather(1, top_idx)
+    else:
+        p = k * F.softmax(top_logits, dim=1)
+    weight = 1 + p - p.detach()
+    if side == 'both':
+        pairs = torch.cat([rows.unsqueeze(2).expand(n, k, k, rows.size(2)), candidates.unsqueeze(1).expand(n, k, k, d)], 3)
+        relations = (g_theta(pairs) * selection.view(n, 1, k, 1)).sum(2)
+    else:
+        relations = g_theta(torch.cat([rows, selected.expand(n, k, d)], 2))
+    return (relations * weight.unsqueeze(2)).sum(1)
+
+
 def sarn_select(coordinate_encoded, logits):
     selection = F.softmax(logits.squeeze(2), dim=1)
     selected = torch.bmm(selection.unsqueeze(1), coordinate_encoded)